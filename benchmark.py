@@ -0,0 +1,374 @@
+# Benchmarks for meeting-start-reminder.py, run offline against a fake Google Calendar API
+# and fake MIDI / Hue / Home Assistant devices:
+#
+#   python3 benchmark.py
+#   python3 benchmark.py --accounts 1,10,50 --events 100,1000 --latency-ms 50
+#
+# It reports how long a poll takes (wall clock and CPU) and how much memory the script uses as the
+# number of accounts and events grows, and how precisely the chime and the lights go off.
+
+import argparse
+import concurrent.futures
+import contextlib
+import datetime
+import email.parser
+import http.server
+import importlib.util
+import io
+import json
+import os
+import random
+import tempfile
+import threading
+import time
+import urllib.parse
+import uuid
+
+# The script has a dash in its name, so it can't be imported the normal way
+spec = importlib.util.spec_from_file_location("reminder", os.path.join(os.path.dirname(os.path.abspath(__file__)), "meeting-start-reminder.py"))
+reminder = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(reminder)
+
+
+class FakeCalendarHttp:
+    # Stands in for httplib2.Http underneath the real Google API client: answers calendarList.list,
+    # events.list (full and incremental syncs, paging) and batch requests from memory
+    def __init__(self, calendars, latency=0.0, error_rate=0.0):
+        self.calendars = calendars  # calendar id -> {event id: event}
+        self.changes = {calendar_id: [] for calendar_id in calendars}  # calendar id -> [(version, event)]
+        self.version = 1
+        self.latency = latency  # seconds per HTTP request, a batch request counts once
+        self.error_rate = error_rate  # fraction of API calls that fail with a 503
+        self.requests = 0
+        self.lock = threading.Lock()
+
+    def change(self, calendar_id, event):
+        with self.lock:
+            self.version += 1
+            if event.get('status') == 'cancelled':
+                self.calendars[calendar_id].pop(event['id'], None)
+            else:
+                self.calendars[calendar_id][event['id']] = event
+            self.changes[calendar_id].append((self.version, event))
+
+    def request(self, uri, method='GET', body=None, headers=None, **kwargs):
+        import httplib2
+        with self.lock:
+            self.requests += 1
+        time.sleep(self.latency)
+        url = urllib.parse.urlsplit(uri)
+        if url.path.startswith('/batch/'):
+            return self.batch(body, headers)
+        status, payload = self.route(method, url.path, urllib.parse.parse_qs(url.query))
+        return httplib2.Response({'status': str(status), 'content-type': 'application/json'}), json.dumps(payload).encode()
+
+    def route(self, method, path, query):
+        if random.random() < self.error_rate:
+            return 503, {'error': {'code': 503, 'message': 'Backend Error'}}
+        parts = [urllib.parse.unquote(part) for part in path.split('/') if part]
+        if parts[-2:] == ['me', 'calendarList']:
+            return 200, {'items': [{'id': calendar_id, 'selected': True, 'primary': calendar_id == 'primary'} for calendar_id in self.calendars]}
+        if parts[-1] == 'events' and method == 'GET' and parts[-2] in self.calendars:
+            return 200, self.list_events(parts[-2], query)
+        return 404, {'error': {'code': 404, 'message': 'Not Found'}}
+
+    def list_events(self, calendar_id, query):
+        get = lambda name: query.get(name, [None])[0]
+        with self.lock:
+            if get('syncToken'):
+                since = int(get('syncToken'))
+                items = [event for version, event in self.changes[calendar_id] if version > since]
+            else:
+                time_min, time_max = get('timeMin'), get('timeMax')
+                items = [event for event in self.calendars[calendar_id].values()
+                         if (not time_min or event['start']['dateTime'] >= time_min[:19])
+                         and (not time_max or event['start']['dateTime'] < time_max[:19])]
+            version = self.version
+        offset = int(get('pageToken') or 0)
+        size = int(get('maxResults') or 250)
+        result = {'items': items[offset:offset + size]}
+        if offset + size < len(items):
+            result['nextPageToken'] = str(offset + size)
+        else:
+            result['nextSyncToken'] = str(version)
+        return result
+
+    def batch(self, body, headers):
+        import httplib2
+        message = email.parser.Parser().parsestr('content-type: %s\r\n\r\n%s' % (headers['content-type'], body))
+        boundary = uuid.uuid4().hex
+        parts = []
+        for part in message.get_payload():
+            method, target, _ = part.get_payload().splitlines()[0].split(' ')
+            url = urllib.parse.urlsplit(target)
+            status, payload = self.route(method, url.path, urllib.parse.parse_qs(url.query))
+            data = json.dumps(payload)
+            # long Content-IDs (calendar ids like someone@group.calendar.google.com) come folded over several lines
+            content_id = ' '.join(part["Content-ID"].split())
+            parts.append(f'--{boundary}\r\nContent-Type: application/http\r\nContent-ID: {content_id.replace("<", "<response-", 1)}\r\n\r\n'
+                         f'HTTP/1.1 {status} OK\r\nContent-Type: application/json\r\nContent-Length: {len(data)}\r\n\r\n{data}\r\n')
+        parts.append(f'--{boundary}--\r\n')
+        return httplib2.Response({'status': '200', 'content-type': f'multipart/mixed; boundary={boundary}'}), ''.join(parts).encode()
+
+
+class FakeMidiPort:
+    # Takes the place of the mido output port, and remembers when each note went out
+    def __init__(self, name, latency=0.0):
+        self.name = name
+        self.closed = False
+        self.latency = latency
+        self.notes = []  # clock time of each note_on
+
+    def send(self, message):
+        time.sleep(self.latency)
+        if message.type == 'note_on':
+            self.notes.append(reminder.clock.time())
+
+    def close(self):
+        self.closed = True
+
+
+class FakeLights:
+    # A local HTTP server that answers like a Hue bridge and like Home Assistant, and remembers
+    # when each scene was activated
+    def __init__(self, latency=0.0):
+        self.scenes = []  # clock time of each scene activation
+        lights = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'  # keep-alive, like the real devices
+
+            def reply(self, payload):
+                time.sleep(latency)
+                body = json.dumps(payload).encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_GET(self):
+                self.reply({'message': 'API running.'})
+
+            def do_PUT(self):
+                # Hue: /api/<username>/groups/1/action
+                self.rfile.read(int(self.headers.get('Content-Length', 0)))
+                lights.scenes.append(reminder.clock.time())
+                self.reply([{'success': {'/groups/1/action/scene': 'benchmark'}}])
+
+            def do_POST(self):
+                # Home Assistant: /api/services/scene/turn_on
+                self.rfile.read(int(self.headers.get('Content-Length', 0)))
+                lights.scenes.append(reminder.clock.time())
+                self.reply([])
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.address = f"127.0.0.1:{self.server.server_address[1]}"
+
+
+class FakeHueBridge:
+    username = 'benchmark'
+
+
+def make_event(event_id, start, email):
+    # A meeting the account has accepted, with one other participant
+    return {'id': event_id, 'iCalUID': f'{event_id}@benchmark', 'status': 'confirmed', 'summary': f'Meeting {event_id}',
+            'eventType': 'default', 'start': {'dateTime': start.strftime('%Y-%m-%dT%H:%M:%SZ')},
+            'attendees': [{'email': email, 'self': True, 'responseStatus': 'accepted'},
+                          {'email': 'someone@example.com', 'responseStatus': 'accepted'}]}
+
+
+def calendar_ids(n_calendars):
+    # The primary calendar and n_calendars - 1 shared ones, with ids like the real ones
+    return ['primary'] + [f'team{c}@group.calendar.google.com' for c in range(1, n_calendars)]
+
+
+def make_accounts(n_accounts, events_per_account, latency, error_rate, first_start, spacing, n_calendars=1):
+    # Adds n_accounts fake accounts to the script, each with n_calendars calendars sharing events_per_account meetings
+    from google.oauth2.credentials import Credentials
+    from google_auth_httplib2 import AuthorizedHttp
+    from googleapiclient.discovery import build
+    apis = {}
+    for a in range(n_accounts):
+        email = f'user{a}@example.com'
+        calendars = {calendar_id: {} for calendar_id in calendar_ids(n_calendars)}
+        for i in range(events_per_account):
+            event = make_event(f'a{a}e{i}', first_start + datetime.timedelta(seconds=i * spacing), email)
+            calendars[calendar_ids(n_calendars)[i % n_calendars]][event['id']] = event
+        api = FakeCalendarHttp(calendars, latency, error_rate)
+        creds = Credentials('token', refresh_token=f'refresh-{a}', client_id='benchmark', client_secret='benchmark',
+                            token_uri='https://oauth2.googleapis.com/token',
+                            expiry=datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None) + datetime.timedelta(days=1))
+        authorized_http = AuthorizedHttp(creds, http=api)
+        service = build('calendar', 'v3', http=authorized_http, static_discovery=True, cache_discovery=False)
+        reminder.credentials_cache[email] = creds
+        reminder.calendar_services[email] = ((creds.client_id, creds.refresh_token), authorized_http, service)
+        apis[email] = api
+    reminder.email_addresses = list(apis)
+    return apis
+
+
+def reset():
+    # Forget everything the script knows about accounts and events
+    for state in (reminder.event_store, reminder.calendar_lists, reminder.missing_calendars, reminder.calendar_services, reminder.credentials_cache,
+                  reminder.account_events, reminder.account_polls, reminder.account_backoff, reminder.account_locks):
+        state.clear()
+    reminder.email_addresses = []
+    reminder.publish_upcoming()
+
+
+def percentiles(samples):
+    samples = sorted(samples)
+    if not samples:
+        return {'p50': float('nan'), 'p95': float('nan'), 'p99': float('nan'), 'max': float('nan')}
+    pick = lambda q: samples[min(len(samples) - 1, int(q * len(samples)))]
+    return {'p50': pick(0.5), 'p95': pick(0.95), 'p99': pick(0.99), 'max': samples[-1]}
+
+
+def bench_polls(n_accounts, events_per_account, latency, error_rate, polls, n_calendars=1):
+    # One full sync, then incremental polls with a changed event in every calendar each time.
+    # With more than one calendar each poll is a batch request.
+    reset()
+    now = reminder.clock.now()
+    apis = make_accounts(n_accounts, events_per_account, latency, error_rate,
+                         now + datetime.timedelta(minutes=10), 2 * reminder.lookahead_hours * 3600 / max(events_per_account, 1), n_calendars)
+
+    start, cpu_start = time.perf_counter(), time.process_time()
+    reminder.getNextEvent()
+    full_sync = (time.perf_counter() - start, time.process_time() - cpu_start)
+
+    durations, cpu = [], []
+    for p in range(polls):
+        for email, api in apis.items():
+            for c, calendar_id in enumerate(calendar_ids(n_calendars)):
+                api.change(calendar_id, make_event(f'new{p}c{c}', now + datetime.timedelta(minutes=30 + p), email))
+        reminder.account_backoff.clear()  # measure every poll, even after an injected error
+        start, cpu_start = time.perf_counter(), time.process_time()
+        reminder.getNextEvent()
+        durations.append(time.perf_counter() - start)
+        cpu.append(time.process_time() - cpu_start)
+    return {
+        'accounts': n_accounts, 'events': events_per_account, 'calendars': n_calendars,
+        'full_sync_s': full_sync[0], 'full_sync_cpu_s': full_sync[1],
+        'poll_s': percentiles(durations), 'poll_cpu_s': sum(cpu) / len(cpu) if cpu else 0.0,
+        'api_requests': sum(api.requests for api in apis.values()),
+        'upcoming': len(reminder.upcoming), 'max_rss_mb': reminder.max_rss_mb(),
+    }
+
+
+def bench_triggers(meetings, gap, sink_latency, slow_api_latency, lights, n_rooms):
+    # Meetings every `gap` (virtual) seconds in n_rooms rooms, polled from an API that takes slow_api_latency to answer,
+    # and measure how far from WARNING_TIME_SECONDS before each meeting the chime and the lights went off
+    reset()
+    fake_lights = FakeLights(sink_latency)
+    midi_port = FakeMidiPort('Benchmark MIDI')
+    reminder.midi_ports[midi_port.name] = midi_port
+
+    # leave time for the first (slow) poll, which makes two API requests
+    first_start = reminder.clock.now().replace(microsecond=0) + datetime.timedelta(
+        seconds=reminder.WARNING_TIME_SECONDS + reminder.PREWARM_SECONDS + 15 + 3 * slow_api_latency * reminder.clock.speed)
+    apis = make_accounts(1, meetings, slow_api_latency, 0.0, first_start, gap)
+
+    # all rooms share the account, the MIDI device and the lights server
+    reminder.rooms = []
+    for r in range(n_rooms):
+        midi = {"device": midi_port.name, "channel": 0, "note": 60, "duration": 0.1}
+        if lights == 'hue':
+            lighting = {"use_hue": True, "use_ha": False, "hue_bridge_ip_address": fake_lights.address, "hue_scene_id": "benchmark"}
+        else:
+            lighting = {"use_hue": False, "use_ha": True, "ha_url": f"http://{fake_lights.address}", "ha_token": "benchmark", "ha_scene_id": "scene.benchmark"}
+        reminder.rooms.append(reminder.Room(f"room{r}" if n_rooms > 1 else "", reminder.email_addresses, lighting, midi, True, True, FakeHueBridge()))
+    reminder.http_session = reminder.trigger_session = None
+    reminder.action_executor = concurrent.futures.ThreadPoolExecutor(
+        max_workers=min(reminder.ACTION_WORKERS * n_rooms, reminder.MAX_ACTION_WORKERS), thread_name_prefix="action")
+    reminder.setup_trigger_actions()
+    intended = [(first_start + datetime.timedelta(seconds=i * gap)).timestamp() - reminder.WARNING_TIME_SECONDS for i in range(meetings)]
+    reminder.getNextEvent()
+
+    # Keep polling the slow API while the triggers go off, like the daemon does
+    done = threading.Event()
+    def poll():
+        while not done.is_set():
+            reminder.getNextEvent()
+    poller = threading.Thread(target=poll, daemon=True)
+    poller.start()
+    expected = meetings * n_rooms
+    deadline = time.monotonic() + 30
+    while (reminder.clock.time() < intended[-1] + 5 or len(midi_port.notes) < expected or len(fake_lights.scenes) < expected) \
+            and time.monotonic() < deadline:
+        time.sleep(0.05)
+    done.set()
+    poller.join()
+
+    def lateness(times):
+        # seconds after the nearest intended time, converted back to real time
+        return [(t - min(intended, key=lambda i: abs(t - i))) / reminder.clock.speed for t in times]
+    return {
+        'meetings': meetings, 'rooms': n_rooms, 'lights': lights, 'slow_api_s': slow_api_latency, 'sink_latency_s': sink_latency,
+        'chime_late_s': percentiles(lateness(midi_port.notes)), 'chimes': len(midi_port.notes),
+        'lights_late_s': percentiles(lateness(fake_lights.scenes)), 'scenes': len(fake_lights.scenes),
+        'api_requests': apis[reminder.email_addresses[0]].requests,
+    }
+
+
+def ms(seconds):
+    return f"{seconds * 1000:8.1f}"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the polling and the triggers of meeting-start-reminder.py against a fake Google Calendar API and fake devices.")
+    parser.add_argument("--accounts", default="1,5,20", help="Comma separated numbers of accounts to poll")
+    parser.add_argument("--events", default="50,500", help="Comma separated numbers of events per account")
+    parser.add_argument("--calendars", default="1,5", help="Comma separated numbers of calendars per account, the events are spread over them")
+    parser.add_argument("--latency-ms", type=float, default=20, help="Latency of each fake API request")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Fraction of API calls that fail")
+    parser.add_argument("--polls", type=int, default=10, help="Incremental polls per size")
+    parser.add_argument("--meetings", type=int, default=20, help="Meetings in the trigger benchmark")
+    parser.add_argument("--rooms", type=int, default=1, help="Rooms announcing each meeting in the trigger benchmark")
+    parser.add_argument("--gap", type=float, default=10, help="Seconds between the meetings in the trigger benchmark")
+    parser.add_argument("--speed", type=float, default=10, help="How much faster than real time the clock runs in the trigger benchmark")
+    parser.add_argument("--sink-latency-ms", type=float, default=50, help="How long the fake lights take to answer")
+    parser.add_argument("--slow-api-ms", type=float, default=2000, help="API latency while the triggers go off")
+    parser.add_argument("--lights", choices=("ha", "hue"), default="ha", help="Which fake lighting system to use")
+    parser.add_argument("--json", help="Also write the results to this file")
+    args = parser.parse_args()
+
+    database = tempfile.NamedTemporaryFile(suffix='.db', delete=False)
+    database.close()
+    reminder.open_event_db(database.name)
+    reminder.rooms = []  # nothing goes off while the polls are measured
+
+    results = {"polls": [], "triggers": None}
+    print("Polling")
+    print(f"{'accounts':>8} {'events':>7} {'cals':>4} {'full sync ms':>12} {'p50 ms':>8} {'p95 ms':>8} {'max ms':>8} {'cpu ms':>8} {'requests':>8} {'rss MB':>7}")
+    for n_accounts in [int(n) for n in args.accounts.split(',')]:
+        for events_per_account in [int(n) for n in args.events.split(',')]:
+            for n_calendars in [int(n) for n in args.calendars.split(',')]:
+                with contextlib.redirect_stdout(io.StringIO()):
+                    result = bench_polls(n_accounts, events_per_account, args.latency_ms / 1000, args.error_rate, args.polls, n_calendars)
+                results["polls"].append(result)
+                print(f"{n_accounts:>8} {events_per_account:>7} {n_calendars:>4} {ms(result['full_sync_s']):>12} {ms(result['poll_s']['p50'])} "
+                      f"{ms(result['poll_s']['p95'])} {ms(result['poll_s']['max'])} {ms(result['poll_cpu_s'])} {result['api_requests']:>8} {result['max_rss_mb']:>7.1f}")
+
+    print(f"\nTriggers ({args.meetings} meetings in {args.rooms} rooms, API answering in {args.slow_api_ms:.0f} ms, lights in {args.sink_latency_ms:.0f} ms, clock x{args.speed:g})")
+    reminder.clock = reminder.VirtualClock(time.time(), args.speed)
+    threading.Thread(target=reminder.continuous_event_check, daemon=True).start()
+    with contextlib.redirect_stdout(io.StringIO()):
+        result = bench_triggers(args.meetings, args.gap, args.sink_latency_ms / 1000, args.slow_api_ms / 1000, args.lights, args.rooms)
+    results["triggers"] = result
+    print(f"{'':>8} {'fired':>7} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'max ms':>8}   (after the intended time, negative is early)")
+    for name, count, late in (("chime", result['chimes'], result['chime_late_s']), ("lights", result['scenes'], result['lights_late_s'])):
+        print(f"{name:>8} {count:>7} {ms(late['p50'])} {ms(late['p95'])} {ms(late['p99'])} {ms(late['max'])}")
+
+    os.unlink(database.name)
+    if args.json:
+        with open(args.json, 'w') as file:
+            json.dump(results, file, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -11,40 +11,122 @@
 
 from __future__ import print_function
 
-import pdb
+import time
+START_TIME = time.perf_counter()  # for --profile-startup
 
 import datetime
 import os.path
-import mido
-import time
 import pytz
 import tzlocal
 import threading
-import phue
-import discoverhue
+import concurrent.futures
+import collections
+import heapq
+import functools
+import random
 import json
+import sqlite3
+import uuid
+import secrets
+import http.server
+import urllib.request
 import argparse
+import types
+import contextlib
+import logging
+import logging.handlers
+import queue
+import atexit
+import importlib
+import resource
+import re
+import sys
 from tzlocal import get_localzone
-from apscheduler.schedulers.background import BackgroundScheduler
-from google.auth.transport.requests import Request
-from google.oauth2.credentials import Credentials
-from google_auth_oauthlib.flow import InstalledAppFlow
-from googleapiclient.discovery import build
-from googleapiclient.errors import HttpError
 
-from mido import Message
-from phue import Bridge
+# The integrations (Google APIs, MIDI, Hue, the scheduler) are imported where they are used,
+# so that e.g. --testmidi doesn't load the Google client, and Home Assistant users never load phue
+
+class Clock:
+    # The time as seen by the polling and triggering code. Benchmarks and --simulate use a VirtualClock instead
+    def time(self):
+        return time.time()
+
+    def monotonic(self):
+        return time.monotonic()
+
+    def now(self):
+        return datetime.datetime.now(pytz.utc)
+
+    def wait(self, condition, timeout):
+        return condition.wait(timeout)
+
+class VirtualClock(Clock):
+    # Starts at `start` (a unix timestamp) and runs `speed` times faster than real time; advance() jumps ahead.
+    # With speed 0 the time only moves on through advance(), which then waits until the trigger thread caught up.
+    def __init__(self, start, speed=1.0):
+        self.start = start
+        self.speed = speed
+        self.real_start = time.monotonic()
+        self.offset = 0.0
+        self.idle = threading.Event()  # set while the trigger thread waits
+
+    def elapsed(self):
+        return (time.monotonic() - self.real_start) * self.speed + self.offset
+
+    def time(self):
+        return self.start + self.elapsed()
+
+    def monotonic(self):
+        return self.elapsed()
+
+    def now(self):
+        return datetime.datetime.fromtimestamp(self.time(), pytz.utc)
+
+    def wait(self, condition, timeout):
+        self.idle.set()
+        return condition.wait(timeout / self.speed if self.speed else None)
+
+    def advance(self, seconds):
+        # let the trigger thread see the new time
+        with trigger_condition:
+            self.offset += seconds
+            self.idle.clear()
+            trigger_condition.notify_all()
+        if not self.speed:
+            self.idle.wait()
+
+class InlineExecutor(concurrent.futures.Executor):
+    # Runs each task straight away in the thread that submits it, see simulate()
+    def submit(self, fn, *args, **kwargs):
+        future = concurrent.futures.Future()
+        try:
+            future.set_result(fn(*args, **kwargs))
+        except Exception as e:
+            future.set_exception(e)
+        return future
 
 # Global variables
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+LATENESS_BUCKETS = (-1, -0.5, -0.25, -0.1, -0.05, -0.01, 0, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 5, 30)  # negative is early
 SCOPES = ['https://www.googleapis.com/auth/calendar.readonly']
-next_event = None
-previous_next_event = 1 # 1 to get it to print the next meeting status when you first run the script
-next_start_time = None
+UpcomingEvent = collections.namedtuple('UpcomingEvent', ['event', 'start_time', 'email'])
+Config = collections.namedtuple('Config', ['email_addresses', 'lighting', 'midi', 'play_sound', 'change_lights',
+                                           'lookahead_hours', 'calendars', 'push', 'metrics_port', 'logging', 'expand_recurring'])  # see compile_config()
+config = None  # the Config in use, only ever replaced as a whole
+SETTINGS_CHECK_SECONDS = 5  # how often we look for changes to the settings files
+settings_mtimes = {}  # file path -> modification time of the version in use
+upcoming = ()  # UpcomingEvents within the lookahead, ordered by start time. Only ever replaced as a whole
+lookahead_hours = 24  # how far ahead meetings are queued up for triggering
 # creds = None
 # email = None
-lock = threading.Lock()
+lock = threading.Lock()  # held while a new upcoming state is built, swapped in and armed, see publish_upcoming()
 email_addresses = []
 hue_bridge = None
+HUE_STATE_TTL_SECONDS = 300  # how long we keep the groups, scenes and sensors of a Hue bridge
+hue_states = {}  # bridge IP address -> HueState, see hue_state()
+BATTERY_CHECK_SECONDS = 3600  # how often the Hue sensor batteries are checked
+LOW_BATTERY_PERCENT = 15
+low_batteries = set()  # (bridge IP address, sensor id) we already warned about
 change_lights = False
 lighting = {
     "use_hue": False,
@@ -56,93 +138,258 @@ lighting = {
     "ha_scene_id": None
 }
 midi = {"device": None}
+push = {"address": None, "port": 8080}  # optional push notifications, see README.md
+metrics_port = 9464  # local metrics endpoint, None to switch it off
+midi_ports = {}  # device name -> MIDI output that stays open between chimes
+midi_lock = threading.Lock()
 play_sound = False
-scheduler = BackgroundScheduler()
-event_triggered = False  # Flag to track if the event action has been triggered
+scheduler = None  # BackgroundScheduler, created in main()
+clock = Clock()
+WARNING_TIME_SECONDS = 15  # the chime and lights go off this long before the meeting starts
+SLEEP_DETECTION_SECONDS = 5  # wall clock running ahead of the monotonic clock by more than this means we were asleep
+MAX_TIMER_WAIT_SECONDS = 60  # the trigger thread checks for sleep at least this often
+Trigger = collections.namedtuple('Trigger', ['fire_at', 'key', 'upcoming_event', 'action', 'prewarm'])  # fire_at is a wall-clock timestamp
+pending_triggers = []  # heap of (monotonic deadline, key, Trigger)
+fired_triggers = set()  # keys of the triggers that already went off
+trigger_condition = threading.Condition()
+ACTION_TIMEOUT_SECONDS = 5  # give up on an action (e.g. a lighting request) after this long
+ACTION_LATENCY_BUDGET_SECONDS = 2  # an action is fired at most this much earlier to make up for its latency
+ACTION_WORKERS = 8  # actions that can run at the same time, per room
+MAX_ACTION_WORKERS = 64
+rooms = []  # Rooms whose meetings are triggered, see main()
+trigger_actions = []  # TriggerActions of all rooms
+action_executor = concurrent.futures.ThreadPoolExecutor(max_workers=ACTION_WORKERS, thread_name_prefix="action")
+PREWARM_SECONDS = 30  # open the lighting connection this long before a trigger
+HTTP_CONNECT_TIMEOUT_SECONDS = 3
+HTTP_RETRIES = 2
+http_session = None  # requests.Session shared by Home Assistant and the Hue bridge, see get_http_session()
+trigger_session = None  # the same without retries, for the triggers
+http_session_lock = threading.Lock()
+event_store = {}  # (email, calendar_id) -> {"events": {event_id: event}, "sync_token": token}
+EVENT_DB_FILE = 'events.db'
+EVENT_TYPES = ['default']  # other types (out of office, focus time, ...) never trigger anything
+EVENT_FIELDS = 'nextPageToken,nextSyncToken,items(id,iCalUID,status,summary,eventType,start,recurrence,recurringEventId,originalStartTime,attendees(email,self,responseStatus))'
+SYNC_WINDOW_FACTOR = 2  # a full sync fetches this many lookaheads worth of events
+BATCH_SIZE = 50  # most requests Google accepts in one batch request
+calendars = "selected"  # "selected", "primary" or a list of calendar IDs, see README.md
+expand_recurring = False  # fetch one master per recurring series and expand its RRULEs here, see expand_recurring_events()
+CALENDAR_LIST_TTL_SECONDS = 6 * 3600  # how long we remember the calendars of an account
+calendar_lists = {}  # email -> (monotonic time fetched, [calendar id])
+missing_calendars = {}  # (email, calendar id) -> monotonic time the calendar wasn't found, skipped for CALENDAR_LIST_TTL_SECONDS
+RATE_LIMIT_REASONS = ('rateLimitExceeded', 'userRateLimitExceeded', 'quotaExceeded')
+event_db = None  # sqlite3 connection, see open_event_db()
+event_db_lock = threading.Lock()
+calendar_services = {}  # email -> (credentials key, authorized http, calendar service)
+POLL_WORKERS = 8  # maximum number of accounts fetched at the same time
+ACCOUNT_TIMEOUT_SECONDS = 20  # how long a poll waits for a single account
+poll_executor = concurrent.futures.ThreadPoolExecutor(max_workers=POLL_WORKERS, thread_name_prefix="poll")
+credentials_cache = {}  # email -> Credentials, see get_credentials()
+TOKEN_REFRESH_MARGIN_SECONDS = 300  # refresh access tokens this long before they expire
+MIN_POLL_INTERVAL_SECONDS = 30  # how often we poll when a meeting is about to start
+MAX_POLL_INTERVAL_SECONDS = 300  # how often we poll when the next meeting is hours away (or there is none)
+effective_poll_interval = 60  # current interval of the getNextEvent job, see update_poll_interval()
+BACKOFF_BASE_SECONDS = 30
+BACKOFF_MAX_SECONDS = 1800
+account_backoff = {}  # email -> (failed polls in a row, monotonic time until which the account is skipped)
+PUSH_CHANNEL_TTL_SECONDS = 7 * 24 * 3600  # how long we ask Google to keep a push channel open
+PUSH_RENEW_MARGIN_SECONDS = 3600  # replace a push channel this long before it expires
+push_channels = {}  # channel id -> {"email", "calendar_id", "resource_id", "expiration"}
+push_token = secrets.token_hex(16)  # sent back with every notification, to check it comes from our channel
+account_locks = {}  # email -> lock held while the account is being synced
+account_polls = {}  # email -> future of the most recent poll of that account
+account_events = {}  # email -> [(start time in UTC, event)] from the last successful poll
 
-debug = 0 # 1 for verbose, 0 for basic output
+LOG_SUBSYSTEMS = ('poll', 'trigger', 'action', 'push', 'midi', 'lights', 'auth', 'store', 'settings')  # levels can be set per subsystem
+LOG_LEVELS = ('DEBUG', 'INFO', 'WARNING', 'ERROR')
+STANDARD_RECORD_FIELDS = set(vars(logging.makeLogRecord({}))) | {'message', 'asctime', 'suppressed'}  # anything else came in extra=
+log = logging.getLogger("calendar_chime")
+poll_log, trigger_log, action_log, push_log, midi_log, lights_log, auth_log, store_log, settings_log = (
+    logging.getLogger(f"calendar_chime.{subsystem}") for subsystem in LOG_SUBSYSTEMS)
+log_queue = queue.SimpleQueue()  # records waiting for the listener thread, see setup_logging()
+log_handler = logging.StreamHandler(sys.stdout)
+log_rate_limit = None  # RateLimitFilter, see setup_logging()
+log_listener = None
+verbose_logging = False  # --verbose logs everything, whatever the settings say
 
 # Main function
 def main():
-    global email_addresses, hue_bridge, lighting, debug, play_sound
+    global email_addresses, rooms, action_executor
     
     # parse command line arguments
     parser = argparse.ArgumentParser(description="This script plays a MIDI note and activates a Hue scene 15s before a google calendar event is about to start. It also activates the lighting for meetings automatically via Hue or Home Assistant. The calendar event must involve at least one other participant, and have been accepted by you. It can handle multiple google calendars, and guide the user through all the settings if required.")
     parser.add_argument("--verbose", action="store_true", help="Enable verbose mode")
+    parser.add_argument("--setup", action="store_true", help="Guide me through the settings and create the missing Google tokens")
     parser.add_argument("--testmidi", action="store_true", help="Test the midi output")
     parser.add_argument("--testlights", action="store_true", help="Test the lighting scene activation")
+    parser.add_argument("--testpush", action="store_true", help="Test the push notification receiver with a fake notification")
+    parser.add_argument("--profile-startup", action="store_true", help="Show how long it takes to load each integration")
+    parser.add_argument("--stats", action="store_true", help="Show the statistics of the running script")
+    parser.add_argument("--rooms", metavar="DIRECTORY", help="Serve one room per settings file in this directory from one process")
+    parser.add_argument("--simulate", metavar="TIMELINE", help="Replay a timeline of calendar snapshots (see timeline.json.example) and show which triggers fire when, without Google or any devices")
     args = parser.parse_args()
 
+    setup_logging(args.verbose, background=not args.simulate)
     if args.verbose:
         print("Verbose mode is enabled.")
-        debug = 1
+
+    if args.profile_startup:
+        profile_startup()
+        return
+
+    if args.simulate:
+        simulate(args.simulate)
+        return
+
+    if args.setup:
+        # The only mode that asks questions
+        load_settings('settings.json')
+        print("Searching for credentials for email addresses")
+        for email in email_addresses:
+            load_credentials(email, True, True)
+        return
 
     # Load settings
-    load_settings('settings.json')
+    if args.rooms:
+        if os.path.exists('settings.json'):
+            try:
+                apply_config(read_config('settings.json', require_accounts=False))
+            except Exception as e:
+                print(f"❌  ERROR: {e}")
+                return
+        rooms = load_rooms(args.rooms)
+        if not rooms:
+            print(f"❌  ERROR: no rooms found in {args.rooms}")
+            return
+        email_addresses = tuple(sorted({email for room in rooms for email in room.email_addresses}))
+        action_executor = concurrent.futures.ThreadPoolExecutor(max_workers=min(ACTION_WORKERS * len(rooms), MAX_ACTION_WORKERS), thread_name_prefix="action")
+        log.info("🏢 %d rooms, %d accounts", len(rooms), len(email_addresses))
+    else:
+        try:
+            apply_config(read_config('settings.json'))
+        except Exception as e:
+            print(f"❌  ERROR: {e}")
+            print("    Run 'python3 meeting-start-reminder.py --setup' to fix the settings")
+            return
 
     if args.testmidi:
         print("Testing MIDI output.")
         if play_sound:
             try:
+                start = time.perf_counter()
+                open_midi_port(midi.get("device"))
+                opened = time.perf_counter()
                 bong(1, midi.get("device"), midi.get("channel"), midi.get("note"), midi.get("duration"))
+                sent = time.perf_counter()
                 print('    MIDI note sent. Did you hear a sound?')
+                print(f'    Opening the port took {(opened - start) * 1000:.1f} ms, sending the note took {(sent - opened) * 1000:.2f} ms')
+                time.sleep(midi.get("duration") + 0.1)  # let the note_off go out before closing the port
+                close_midi_port()
             except Exception as e:
                 print(f'    ⚠️  ERROR: could not play a sound: {e} ⚠️')
         else:
             print("    ❌ Error with MIDI settings.")
         return
 
+    if args.stats:
+        print("Statistics:")
+        print_stats(metrics_port or 9464)
+        return
+
+    if args.testpush:
+        print("Testing push notification receiver.")
+        test_push_receiver()
+        return
+
     if args.testlights:
         print("Testing lighting scene activation.")
         if lighting.get("use_hue"):
             connectToBridge()
             try:
-                hue_bridge.activate_scene(1, lighting.get("hue_scene_id"), 0)
+                activate_hue_scene(single_room(), None, ACTION_TIMEOUT_SECONDS)
                 print('    Hue scene activated. Did you see the lights turn on?')
             except Exception as e:
                 print(f'    ❌  ERROR: could not activate the scene: {e}')
         elif lighting.get("use_ha"):
             try:
-                # activate HA scene
-                import requests
-                url = f"{lighting['ha_url']}/api/services/scene/turn_on"
-                headers = {
-                    "Authorization": f"Bearer {lighting['ha_token']}",
-                    "Content-Type": "application/json"
-                }
-                payload = {"entity_id": lighting['ha_scene_id']}
-                response = requests.post(url, headers=headers, json=payload)
-                if response.status_code == 200:
-                    print("Home Assistant scene activated successfully.")
-                else:
-                    print(f"    ❌  Failed to activate Home Assistant scene: {response.text}")
+                activate_ha_scene(single_room(), None, ACTION_TIMEOUT_SECONDS)
             except Exception as e:
                 print(f'    ❌  ERROR: could not activate the scene: {e}')
         else:
             print("    ❌ Error with lighting settings.")
         return
 
+    global scheduler
+    from apscheduler.schedulers.background import BackgroundScheduler
+    scheduler = BackgroundScheduler()
+
     # Connect to Hue bridge
-    if lighting.get("use_hue"):
-        connectToBridge()
+    if args.rooms:
+        connect_room_bridges()
+    else:
+        if change_lights and lighting.get("use_hue"):
+            connectToBridge()
+        rooms = [single_room()]
+    check_hue_scenes()
+
+    # Open the MIDI devices now rather than when the chime needs to play
+    devices = midi_devices()
+    for device in devices:
+        try:
+            open_midi_port(device)
+        except Exception as e:
+            midi_log.warning("⚠️  Could not open MIDI device '%s', will retry: %s", device, e)
+    if devices:
+        scheduler.add_job(check_midi_ports, 'interval', seconds=30, id='check_midi_ports', coalesce=True)
 
-    # Try loading or creating credentials for Google Calendar API
-    print("=============================================")
-    print("Searching for credentials for email addresses")
+    # Start triggering straight away from the events we saved last time
+    setup_trigger_actions()
+    open_event_db()
+    load_event_store()
+    publish_upcoming()
+    threading.Thread(target=continuous_event_check, daemon=True).start()
+
+    # Load the credentials for Google Calendar API, --setup creates missing ones
+    log.info("=============================================")
+    log.info("Searching for credentials for email addresses")
     for email in email_addresses:
         # Load credentials for the account in verbose mode
-        account_creds = load_credentials(email, True, True)
-    print("=============================================")
+        account_creds = load_credentials(email, False, True)
+        if account_creds:
+            credentials_cache[email] = account_creds
+    log.info("=============================================")
+    scheduler.add_job(refresh_credentials, 'interval', seconds=60, coalesce=True)
+    scheduler.add_job(check_sensor_batteries, 'interval', seconds=BATTERY_CHECK_SECONDS, coalesce=True,
+                      next_run_time=datetime.datetime.now() + datetime.timedelta(seconds=60))
+
+    # Pick up changes to the settings without a restart
+    if args.rooms:
+        scheduler.add_job(reload_rooms, 'interval', args=[args.rooms], seconds=SETTINGS_CHECK_SECONDS, coalesce=True)
+    else:
+        scheduler.add_job(reload_settings, 'interval', seconds=SETTINGS_CHECK_SECONDS, coalesce=True)
 
     # Get next calendar event, and re-run periodically
     getNextEvent() # run the first time
-    scheduler.add_job(getNextEvent, 'interval', seconds=60, coalesce=True, misfire_grace_time=60)
-    if (debug): print("Job scheduled for getNextEvent")
+    scheduler.add_job(getNextEvent, 'interval', seconds=effective_poll_interval, id='getNextEvent', coalesce=True, misfire_grace_time=60)
+    poll_log.debug("Job scheduled for getNextEvent")
     scheduler.start()
-    if (debug): print("Scheduler started")
+    log.debug("Scheduler started")
 
-    # Start a thread to continuously check event timing
-    threading.Thread(target=continuous_event_check, daemon=True).start()
+    if metrics_port:
+        try:
+            start_metrics_server(metrics_port)
+            log.debug("Metrics on http://127.0.0.1:%d/metrics", metrics_port)
+        except Exception as e:
+            log.warning("⚠️  Could not start the metrics endpoint on port %s: %s", metrics_port, e)
+
+    # Optionally get told about changes straight away, polling carries on as a fallback
+    if push.get("address"):
+        try:
+            start_push_receiver(push.get("port", 8080), on_calendar_changed)
+            push_log.info("📬 Listening for push notifications on port %d", push.get('port', 8080))
+            renew_push_channels()
+            scheduler.add_job(renew_push_channels, 'interval', minutes=30, coalesce=True)
+        except Exception as e:
+            push_log.error("❌  ERROR: could not start push notifications, polling only: %s", e)
 
     # Don't crash if computer goes to sleep
     try:
@@ -150,203 +397,1556 @@ def main():
             time.sleep(1)  # Keeps the main thread alive
     except (KeyboardInterrupt, SystemExit):
         scheduler.shutdown()
+        for channel_id in list(push_channels):
+            stop_push_channel(channel_id)
+        close_midi_port()
+
+def profile_startup():
+    # Import time and memory of each integration, in the order the daemon loads them.
+    # Each line only counts what wasn't already loaded by the ones above it.
+    # (python -X importtime gives the full tree)
+    print("Startup profile:")
+    print(f"    {'Script and standard library:':<36} {(time.perf_counter() - START_TIME) * 1000:7.1f} ms   {max_rss_mb():6.1f} MB")
+    integrations = [
+        ("apscheduler.schedulers.background", "Scheduler"),
+        ("google.oauth2.credentials", "Google auth"),
+        ("google_auth_oauthlib.flow", "Google OAuth flow"),
+        ("googleapiclient.discovery", "Google Calendar API"),
+        ("google_auth_httplib2", "Google HTTP transport"),
+        ("dateutil.rrule", "Recurring events (expand_recurring)"),
+        ("requests", "HTTP sessions (Home Assistant, Hue)"),
+        ("mido", "MIDI"),
+        ("rtmidi", "MIDI backend"),
+        ("phue", "Hue"),
+        ("discoverhue", "Hue discovery (setup only)"),
+    ]
+    for module, name in integrations:
+        start = time.perf_counter()
+        try:
+            importlib.import_module(module)
+        except ImportError as e:
+            print(f"    {name + ':':<36} not installed ({e})")
+            continue
+        print(f"    {name + ':':<36} {(time.perf_counter() - start) * 1000:7.1f} ms   {max_rss_mb():6.1f} MB")
+    print(f"    Total: {(time.perf_counter() - START_TIME) * 1000:.1f} ms, peak memory {max_rss_mb():.1f} MB")
+
+def max_rss_mb():
+    # ru_maxrss is in bytes on macOS and in kilobytes on Linux
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / (1024 * 1024) if sys.platform == 'darwin' else rss / 1024
 
 def connectToBridge():
     global lighting, hue_bridge
+    import phue
     if hue_bridge is None:
         try:
-            hue_bridge = Bridge(lighting.get("hue_bridge_ip_address"))
+            hue_bridge = phue.Bridge(lighting.get("hue_bridge_ip_address"))
             hue_bridge.connect()
-            print("Successfully connected to the Hue bridge ({}).".format(lighting.get("hue_bridge_ip_address")))
+            lights_log.info("Successfully connected to the Hue bridge (%s).", lighting.get("hue_bridge_ip_address"))
         except phue.PhueRegistrationException:
-            print("Go press the button on your Hue bridge, and then re-run this script within 30s")
+            lights_log.warning("Go press the button on your Hue bridge, and then re-run this script within 30s")
             return    
         except Exception as e:
-            print(f"Failed to connect to the Hue bridge: {e}")
+            lights_log.error("Failed to connect to the Hue bridge: %s", e)
             return
 
 def getNextEvent():
-    if (debug): print("getNextEvent called", flush=True)
-    global next_event, previous_next_event, next_start_time, email_addresses, event_triggered
+    poll_log.debug("getNextEvent called")
 
-    with lock:
+    # The fetch happens without holding the lock, so it can never delay a trigger
+    now = clock.now().isoformat().replace('+00:00', 'Z')
+
+    # Fetch all accounts at the same time, so one slow account doesn't hold up the others
+    polls = []
+    for email in email_addresses:
+        running = account_polls.get(email)
+        if running is not None and not running.done():
+            poll_log.debug("Previous poll for %s is still running, using the last known events", email, extra={"account": email})
+            continue
+        if email in account_backoff and account_backoff[email][1] > time.monotonic():
+            poll_log.debug("Backing off %s for another %.0fs", email, account_backoff[email][1] - time.monotonic(), extra={"account": email})
+            continue
+        future = poll_executor.submit(poll_account, email, now)
+        account_polls[email] = future
+        polls.append(future)
+    done, not_done = concurrent.futures.wait(polls, timeout=ACCOUNT_TIMEOUT_SECONDS)
+    if not_done:
+        poll_log.warning("⚠️  %d account(s) did not respond within %ds, using the last known events", len(not_done), ACCOUNT_TIMEOUT_SECONDS)
+
+    publish_upcoming()
+    update_poll_interval()
+
+def update_poll_interval():
+    # Poll rarely while the next meeting is far away, and more often as its trigger gets closer
+    global effective_poll_interval
+    interval = MAX_POLL_INTERVAL_SECONDS
+    if upcoming:
+        seconds_to_trigger = (upcoming[0].start_time - clock.now()).total_seconds() - WARNING_TIME_SECONDS
+        interval = min(max(seconds_to_trigger / 10, MIN_POLL_INTERVAL_SECONDS), MAX_POLL_INTERVAL_SECONDS)
+    interval = int(interval)
+    if interval != effective_poll_interval:
+        effective_poll_interval = interval
+        if scheduler and scheduler.get_job('getNextEvent'):
+            scheduler.reschedule_job('getNextEvent', trigger='interval', seconds=interval)
+    poll_log.debug("Polling every %ds", effective_poll_interval)
+
+def merge_meetings(emails, now_dt_utc, horizon):
+    # Merge the meetings of the accounts into one queue of UpcomingEvents, ordered by start time.
+    # The same meeting in several calendars (same iCalUID) only appears once.
+    queue = []
+    seen = set()
+    account_meetings = [[(start_dt_utc, email, event) for start_dt_utc, event in account_events.get(email, [])]
+                        for email in emails]
+    for start_dt_utc, email, event in heapq.merge(*account_meetings, key=lambda meeting: meeting[0]):
+        if start_dt_utc <= now_dt_utc:
+            continue
+        if start_dt_utc > horizon:
+            break
+        key = (event.get('iCalUID', event['id']), start_dt_utc)
+        if key not in seen:
+            seen.add(key)
+            queue.append(UpcomingEvent(event, start_dt_utc, email))
+    return tuple(queue)
+
+def publish_upcoming():
+    # Make the meetings of all accounts the new upcoming state, and each room's share of them its upcoming state.
+    # Polls, push notifications and reloads publish from different threads: building the snapshot, swapping it
+    # in and arming its triggers all happen under the lock, so an older snapshot can never replace a newer one
+    # and the pending triggers always belong to the upcoming state.
+    global upcoming
+    with timed_lock(lock, "upcoming"):
+        now_dt_utc = clock.now()
+        horizon = now_dt_utc + datetime.timedelta(hours=lookahead_hours)
+        queue = merge_meetings(email_addresses, now_dt_utc, horizon)
+        room_queues = [queue if room.email_addresses == email_addresses else merge_meetings(room.email_addresses, now_dt_utc, horizon)
+                       for room in rooms]
+        previous = upcoming
+        upcoming = queue
+        for room, room_queue in zip(rooms, room_queues):
+            room.upcoming = room_queue
+        arm_triggers()
+
+    if queue:
+        next_meeting = queue[0]
+        # Convert UTC to local time before printing
+        local_next_start_time = next_meeting.start_time.astimezone(get_localzone())
+        if not previous or previous[0].event != next_meeting.event:
+            log.info("Next meeting is: %s at %s (%s)", event_title(next_meeting.event), local_next_start_time, next_meeting.email,
+                     extra={"event_id": next_meeting.event['id'], "account": next_meeting.email})
+        if log.isEnabledFor(logging.DEBUG):
+            for later_meeting in queue[1:]:
+                log.debug("    then: %s at %s (%s)", event_title(later_meeting.event), later_meeting.start_time.astimezone(get_localzone()), later_meeting.email)
+    else:
+        if previous: log.info('No upcoming meetings found.')
+
+def fetch_account_events(email, now, calendar_ids=None):
+    # Runs in the poll thread pool. Syncs the account's calendars (or only the given ones) and
+    # returns the accepted, upcoming meetings of the account as a list of (start time in UTC, event),
+    # together with the errors of the calendars that couldn't be synced
+    account_creds = get_credentials(email)
+    if not account_creds:
+        # print(f"Skipping account {email} due to missing credentials.")
+        return None, {}
+
+    # Polls and push notifications can ask for the same account at the same time
+    with timed_lock(account_locks.setdefault(email, threading.Lock()), "account"):
+        start = time.perf_counter()
+        service = get_calendar_service(email, account_creds)
+        all_calendar_ids = account_calendars(email)
+        for (store_email, calendar_id) in list(event_store):
+            if store_email == email and calendar_id not in all_calendar_ids:
+                forget_calendar(email, calendar_id)
         try:
-            now = datetime.datetime.now(datetime.timezone.utc).isoformat().replace('+00:00', 'Z')
-            earliest_event = None
-            earliest_start_time = None
-            next_email = None
-
-            for email in email_addresses:
-                # Load credentials for the account
-                account_creds = load_credentials(email, False, False)
-                if not account_creds:
-                    # print(f"Skipping account {email} due to missing credentials.")
+            errors = sync_calendars(service, email, calendar_ids or all_calendar_ids, now)
+        finally:
+            metrics.observe("calendar_chime_poll_duration_seconds", time.perf_counter() - start, account=email)
+        return accepted_meetings(email, stored_events(email)), errors
+
+def account_calendars(email):
+    # The calendars of an account we look at, see "calendars" in README.md.
+    # Call with account_locks[email] held: it may use the account's (not thread-safe) HTTP connection
+    if isinstance(calendars, (list, tuple)):
+        # the same list is used for every account, skip the calendars this account doesn't have
+        return [calendar_id for calendar_id in calendars
+                if time.monotonic() - missing_calendars.get((email, calendar_id), -CALENDAR_LIST_TTL_SECONDS) >= CALENDAR_LIST_TTL_SECONDS]
+    if calendars == "primary":
+        return ['primary']
+    cached = calendar_lists.get(email)
+    if cached and time.monotonic() - cached[0] < CALENDAR_LIST_TTL_SECONDS:
+        return cached[1]
+
+    try:
+        service = get_calendar_service(email, get_credentials(email))
+        calendar_ids = []
+        page_token = None
+        while True:
+            metrics.inc("calendar_chime_api_calls_total", account=email, method="calendarList.list")
+            result = service.calendarList().list(fields='nextPageToken,items(id,primary,selected)',
+                                                 pageToken=page_token).execute()
+            calendar_ids.extend(item['id'] for item in result.get('items', []) if item.get('selected') or item.get('primary'))
+            page_token = result.get('nextPageToken')
+            if not page_token:
+                break
+    except Exception as e:
+        # keep going with what we knew before
+        poll_log.warning("⚠️  Could not get the calendar list for %s: %s", email, e, extra={"account": email})
+        if cached:
+            return cached[1]
+        return [calendar_id for (store_email, calendar_id) in list(event_store) if store_email == email] or ['primary']
+    if not cached or cached[1] != calendar_ids: poll_log.info("Calendars for %s: %s", email, ', '.join(calendar_ids), extra={"account": email})
+    calendar_lists[email] = (time.monotonic(), calendar_ids)
+    return calendar_ids
+
+def event_title(event):
+    # Google leaves the summary out of untitled events
+    return event.get('summary', '(no title)')
+
+def stored_events(email):
+    # All events in the local store for one account, across its calendars
+    return [event for (store_email, calendar_id), store in list(event_store.items()) if store_email == email
+            for event in store["events"].values()]
+
+def accepted_meetings(email, events, now_dt_utc=None):
+    # The events that will trigger the chime: timed, normal meetings that I've accepted,
+    # as a list of (start time in UTC, event). Recurring series are expanded over the sync window.
+    now_dt_utc = now_dt_utc or clock.now()
+    meetings = []
+    for event in expand_recurring_events(events, now_dt_utc, now_dt_utc + datetime.timedelta(hours=SYNC_WINDOW_FACTOR * lookahead_hours)):
+        if 'dateTime' in event['start'] and event['eventType'] == 'default':
+            start_dt_utc = parse_event_time(event['start']['dateTime'])
+        else:
+            continue
+
+        if 'attendees' in event and any(attendee['email'] == email and attendee['responseStatus'] == 'accepted' for attendee in event['attendees']):
+            meetings.append((start_dt_utc, event))
+    meetings.sort(key=lambda meeting: meeting[0])
+    return meetings
+
+def expand_recurring_events(events, now_dt_utc, horizon):
+    # With expand_recurring the store holds one master event per series (with its RRULEs), plus the
+    # instances that were moved, changed or cancelled. Turn them into the instances between now and
+    # the horizon, as singleEvents=True would have returned them (with the same instance IDs)
+    masters = [event for event in events if event.get('recurrence') and event.get('status') != 'cancelled']
+    instances = [event for event in events if not event.get('recurrence') and event.get('status') != 'cancelled']
+    if not masters:
+        return instances
+    # Instances that are in the store themselves (moved, changed or cancelled) replace the RRULE's version
+    exceptions = {(event['recurringEventId'], parse_event_time(event['originalStartTime']['dateTime']))
+                  for event in events if 'recurringEventId' in event and 'dateTime' in event.get('originalStartTime', {})}
+    days = [now_dt_utc.date() + datetime.timedelta(days=n) for n in range((horizon.date() - now_dt_utc.date()).days + 1)]
+    for master in masters:
+        start = master['start']
+        if 'dateTime' not in start:
+            continue  # all-day series never trigger anything
+        for day in days:
+            for start_dt_utc in recurrence_starts(tuple(master['recurrence']), start['dateTime'], start.get('timeZone'), day):
+                if (master['id'], start_dt_utc) in exceptions or not now_dt_utc <= start_dt_utc <= horizon:
                     continue
+                start_time = {'dateTime': start_dt_utc.isoformat().replace('+00:00', 'Z'), 'timeZone': start.get('timeZone')}
+                instance = dict(master, id=f"{master['id']}_{start_dt_utc:%Y%m%dT%H%M%SZ}", recurringEventId=master['id'],
+                                start=start_time, originalStartTime=start_time)
+                del instance['recurrence']
+                instances.append(instance)
+    return instances
 
-                service = build('calendar', 'v3', credentials=account_creds)
-                events_result = service.events().list(calendarId='primary', timeMin=now,
-                                                      maxResults=10, singleEvents=True,
-                                                      orderBy='startTime').execute()
-                events = events_result.get('items', [])
-                # if not events:
-                #     print('No upcoming events found.')
-                #     return
-
-                for event in events:
-                    start_dt = None
-                    if 'dateTime' in event['start'] and event['eventType'] == 'default':
-                        start_dt = datetime.datetime.strptime(event['start'].get('dateTime'), '%Y-%m-%dT%H:%M:%S%z')
-                        start_dt_utc = start_dt.astimezone(pytz.utc)
-                        now_dt_utc = datetime.datetime.now(pytz.utc)
-                    else:
-                        continue
+@functools.lru_cache(maxsize=4096)
+def recurrence_starts(recurrence, start_time, time_zone, day):
+    # The start times (in UTC) of a series' instances on one day (in UTC). The rules are expanded in the
+    # event's own time zone, so a 9:30 meeting stays at 9:30 across daylight saving changes. Cached per
+    # day, so a poll only expands the day that just came into the lookahead
+    from dateutil import rrule
+    dtstart = parse_event_time(start_time)
+    tz = pytz.timezone(time_zone) if time_zone else pytz.utc
+    local_start = dtstart.astimezone(tz).replace(tzinfo=None)
+    rules = rrule.rruleset()
+    rules.rdate(local_start)
+    for line in recurrence:
+        name, _, value = line.partition(':')
+        name, *params = name.split(';')
+        if name == 'RRULE':
+            rules.rrule(rrule.rrulestr(local_until(value, tz), dtstart=local_start))
+        elif name in ('EXDATE', 'RDATE'):
+            for local in recurrence_dates(params, value, tz, local_start):
+                (rules.exdate if name == 'EXDATE' else rules.rdate)(local)
+    day_start = datetime.datetime.combine(day, datetime.time(), pytz.utc)
+    day_end = day_start + datetime.timedelta(days=1)
+    # a UTC day is within a day either side in local time
+    between = rules.between((day_start - datetime.timedelta(days=1)).astimezone(tz).replace(tzinfo=None),
+                            (day_end + datetime.timedelta(days=1)).astimezone(tz).replace(tzinfo=None), inc=True)
+    starts = (tz.normalize(tz.localize(local)).astimezone(pytz.utc) for local in between)
+    return tuple(start_dt_utc for start_dt_utc in starts if day_start <= start_dt_utc < day_end)
+
+def local_until(rule, tz):
+    # UNTIL is in UTC, but the rule is expanded in the event's time zone
+    def to_local(match):
+        until = datetime.datetime.strptime(match.group(1), '%Y%m%dT%H%M%S').replace(tzinfo=pytz.utc)
+        return 'UNTIL=' + until.astimezone(tz).strftime('%Y%m%dT%H%M%S')
+    return re.sub(r'UNTIL=(\d{8}T\d{6})Z', to_local, rule)
+
+def recurrence_dates(params, value, tz, local_start):
+    # The dates of an EXDATE or RDATE line, as local times in the event's time zone
+    tzid = next((param[len('TZID='):] for param in params if param.startswith('TZID=')), None)
+    for text in value.split(','):
+        if len(text) == 8:  # VALUE=DATE, the instance on that day
+            yield datetime.datetime.combine(datetime.datetime.strptime(text, '%Y%m%d').date(), local_start.time())
+        elif text.endswith('Z'):
+            yield datetime.datetime.strptime(text, '%Y%m%dT%H%M%SZ').replace(tzinfo=pytz.utc).astimezone(tz).replace(tzinfo=None)
+        elif tzid:
+            yield pytz.timezone(tzid).localize(datetime.datetime.strptime(text, '%Y%m%dT%H%M%S')).astimezone(tz).replace(tzinfo=None)
+        else:
+            yield datetime.datetime.strptime(text, '%Y%m%dT%H%M%S')
+
+def poll_account(email, now, calendar_ids=None):
+    # Runs in the poll thread pool: fetch the account and store its meetings, even if getNextEvent already
+    # stopped waiting for it. The result is stored before the future is done, so getNextEvent always
+    # publishes the polls it waited for (done callbacks only run after the waiters have been woken up)
+    from googleapiclient.errors import HttpError
+    try:
+        meetings, errors = fetch_account_events(email, now, calendar_ids)
+    except HttpError as error:
+        poll_log.error('An error occurred for %s: %s', email, error, extra={"account": email, "status": error.resp.status})
+        metrics.inc("calendar_chime_poll_errors_total", account=email)
+        if error.resp.status in (403, 429) or error.resp.status >= 500:
+            back_off(email)
+        return
+    except Exception as e:
+        poll_log.error('❌  ERROR: could not fetch events for %s: %s', email, e, extra={"account": email})
+        metrics.inc("calendar_chime_poll_errors_total", account=email)
+        return
+    # Some calendars failed, the others were synced. Only a rate limit backs off the whole account
+    if any(is_rate_limited(error) for error in errors.values()):
+        back_off(email)
+    else:
+        account_backoff.pop(email, None)
+    if meetings is not None:
+        account_events[email] = meetings
+
+def is_rate_limited(error):
+    from googleapiclient.errors import HttpError
+    if not isinstance(error, HttpError):
+        return False
+    details = error.error_details if isinstance(error.error_details, list) else []
+    return error.resp.status == 429 or (error.resp.status == 403 and
+                                        any(isinstance(detail, dict) and detail.get('reason') in RATE_LIMIT_REASONS for detail in details))
+
+def back_off(email):
+    # Exponential backoff with full jitter, so we don't keep hammering a quota or a failing server
+    failures = account_backoff.get(email, (0, 0))[0] + 1
+    delay = random.uniform(0, min(BACKOFF_MAX_SECONDS, BACKOFF_BASE_SECONDS * 2 ** failures))
+    account_backoff[email] = (failures, time.monotonic() + delay)
+    poll_log.warning("⏳ Backing off %s for %.0fs (%d failed polls in a row)", email, delay, failures, extra={"account": email})
+
+def get_calendar_service(email, account_creds):
+    # Building a service parses the discovery document and sets up a new HTTP transport,
+    # so do it once per account and only rebuild when the account's credentials change
+    from googleapiclient.discovery import build
+    from google_auth_httplib2 import AuthorizedHttp
+    import httplib2
+    key = (account_creds.client_id, account_creds.refresh_token)
+    cached = calendar_services.get(email)
+    if cached and cached[0] == key:
+        key, authorized_http, service = cached
+        authorized_http.credentials = account_creds  # pick up a refreshed access token
+        return service
+
+    poll_log.debug("Building calendar service for %s", email, extra={"account": email})
+    authorized_http = AuthorizedHttp(account_creds, http=httplib2.Http(timeout=ACCOUNT_TIMEOUT_SECONDS))
+    service = build('calendar', 'v3', http=authorized_http, static_discovery=True, cache_discovery=False)
+    calendar_services[email] = (key, authorized_http, service)
+    return service
 
-                    if 'attendees' in event and any(attendee['email'] == email and attendee['responseStatus'] == 'accepted' for attendee in event['attendees']):
-                        if start_dt_utc > now_dt_utc:
-                            # Compare to find the earliest event across all accounts
-                            if earliest_event is None or start_dt_utc < earliest_start_time:
-                                earliest_event = event
-                                earliest_start_time = start_dt_utc
-                                next_email = email
-            
-            # Update global variables with the earliest event
-            previous_next_event = next_event
-            next_event = earliest_event
-            next_start_time = earliest_start_time
-            
-            # Get the local timezone dynamically
-            local_tz = get_localzone()
-
-            if next_event:
-                # print('previous next event: {}'.format(previous_next_event))
-                # print('new next event: {}'.format(next_event))
-                # Convert UTC to local time before printing
-                local_next_start_time = next_start_time.astimezone(local_tz)
-                if (debug) or (previous_next_event != next_event): print(f"Next meeting is: {next_event['summary']} at {local_next_start_time} ({next_email})")
-                event_triggered = False  # Reset the flag for new event
+def sync_calendars(service, email, calendar_ids, time_min):
+    # Keep a local copy of the calendars and only download what changed since the last poll.
+    # The first sync of a calendar is a full sync from time_min onwards, after that we use its syncToken.
+    # The requests for all calendars of the account go out together as one batch request.
+    from googleapiclient.errors import HttpError
+    now_dt_utc = clock.now()
+    time_max = (now_dt_utc + datetime.timedelta(hours=SYNC_WINDOW_FACTOR * lookahead_hours)).isoformat().replace('+00:00', 'Z')
+    expanded = expand_recurring
+    syncs = {}
+    for calendar_id in calendar_ids:
+        store = event_store.setdefault((email, calendar_id), {"events": {}, "sync_token": None, "window_end": None, "expanded": False})
+        # A full sync only covers SYNC_WINDOW_FACTOR lookaheads, start a new window before we run out of it
+        if store["sync_token"] and (store.get("window_end") is None or
+                                    parse_event_time(store["window_end"]) - now_dt_utc < datetime.timedelta(hours=lookahead_hours)):
+            poll_log.debug("Sync window for %s (%s) ends soon, doing a full resync", email, calendar_id, extra={"account": email})
+            store["sync_token"] = None
+        # A sync token only works with the singleEvents it was made with
+        if store["sync_token"] and store.get("expanded", False) != expanded:
+            poll_log.debug("expand_recurring changed for %s (%s), doing a full resync", email, calendar_id, extra={"account": email})
+            store["sync_token"] = None
+        syncs[calendar_id] = {"sync_token": store["sync_token"], "page_token": None, "items": [], "expanded": expanded}
+
+    errors = {}
+    pending = list(syncs)
+    while pending:
+        metrics.inc("calendar_chime_api_calls_total", len(pending), account=email, method="events.list")
+        results = execute_batch(service, [(calendar_id, events_request(service, calendar_id, syncs[calendar_id], time_min, time_max))
+                                          for calendar_id in pending])
+        pending = []
+        for calendar_id, (response, error) in results.items():
+            sync = syncs[calendar_id]
+            if error is not None:
+                metrics.inc("calendar_chime_api_errors_total", account=email,
+                            status=error.resp.status if isinstance(error, HttpError) else type(error).__name__)
+                if isinstance(error, HttpError) and error.resp.status == 410 and sync["sync_token"]:
+                    # 410 GONE: the sync token is no longer valid, start again from scratch
+                    poll_log.info("Sync token expired for %s (%s), doing a full resync", email, calendar_id, extra={"account": email})
+                    syncs[calendar_id] = {"sync_token": None, "page_token": None, "items": [], "expanded": expanded}
+                    pending.append(calendar_id)
+                else:
+                    if isinstance(error, HttpError) and error.resp.status == 404:
+                        # Not one of this account's calendars, don't ask again for a while
+                        missing_calendars[(email, calendar_id)] = time.monotonic()
+                    errors[calendar_id] = error
+                    del syncs[calendar_id]
+                continue
+            sync["items"].extend(response.get('items', []))
+            sync["page_token"] = response.get('nextPageToken')
+            if sync["page_token"]:
+                pending.append(calendar_id)
             else:
-                if (debug) or (previous_next_event != next_event): print('No upcoming meetings found.')
-                # Clear the event details if no valid events
-                previous_next_event = None
-                next_event = None
-                next_start_time = None
+                sync["next_sync_token"] = response.get('nextSyncToken')
+
+    for calendar_id, sync in syncs.items():
+        apply_sync(email, calendar_id, sync, time_max, now_dt_utc)
+    if errors and not syncs:
+        raise next(iter(errors.values()))
+    for calendar_id, error in errors.items():
+        poll_log.warning("⚠️ Couldn't sync %s (%s), keeping its last known events: %s", email, calendar_id, error, extra={"account": email})
+    return errors
 
+def events_request(service, calendar_id, sync, time_min, time_max):
+    # Only asks for the fields we use, only regular events, and only my own attendee entry
+    # (maxAttendees=1), which keeps the responses small for meetings with many attendees.
+    # With expand_recurring a recurring series comes back once instead of once per instance.
+    single_events = not sync.get("expanded")
+    if sync["sync_token"]:
+        return service.events().list(calendarId=calendar_id, syncToken=sync["sync_token"], singleEvents=single_events,
+                                     eventTypes=EVENT_TYPES, maxAttendees=1, fields=EVENT_FIELDS,
+                                     maxResults=250, pageToken=sync["page_token"])
+    return service.events().list(calendarId=calendar_id, timeMin=time_min, timeMax=time_max, singleEvents=single_events,
+                                 eventTypes=EVENT_TYPES, maxAttendees=1, fields=EVENT_FIELDS,
+                                 maxResults=250, pageToken=sync["page_token"])
+
+def execute_batch(service, requests):
+    # Runs [(key, request)] in as few round-trips as possible and returns {key: (response, error)}
+    from googleapiclient.errors import HttpError
+    results = {}
+    if len(requests) == 1:
+        key, request = requests[0]
+        try:
+            results[key] = (request.execute(), None)
         except HttpError as error:
-            print(f'An error occurred: {error}')
+            results[key] = (None, error)
+        return results
 
-def continuous_event_check():
-    if (debug): print("Continuous event check started", flush=True)
-    global next_event, next_start_time, event_triggered, lighting, midi, hue_bridge, play_sound, change_lights
-    tolerance_seconds = 5
-    warning_time_seconds = 15
+    def callback(request_id, response, exception):
+        results[request_id] = (response, exception)
+
+    for start in range(0, len(requests), BATCH_SIZE):
+        batch = service.new_batch_http_request(callback=callback)
+        for key, request in requests[start:start + BATCH_SIZE]:
+            batch.add(request, request_id=key)
+        batch.execute()
+    return results
+
+def apply_sync(email, calendar_id, sync, time_max, now_dt_utc):
+    # Update the local store (and the copy on disk) with the result of a sync
+    store = event_store[(email, calendar_id)]
+    full_sync = not sync["sync_token"]
+    if full_sync:
+        store["events"] = {}
+        store["window_end"] = time_max
+        store["expanded"] = sync.get("expanded", False)
+        poll_log.debug("Full sync for %s (%s): %d events", email, calendar_id, len(sync['items']), extra={"account": email})
+    else:
+        poll_log.debug("Incremental sync for %s (%s): %d changed events", email, calendar_id, len(sync['items']), extra={"account": email})
+
+    changed = {}
+    removed = set()
+    for event in sync["items"]:
+        if event.get('status') == 'cancelled' and not (store["expanded"] and 'recurringEventId' in event):
+            store["events"].pop(event['id'], None)
+            removed.add(event['id'])
+        else:
+            # with expand_recurring, a cancelled instance is kept so that its series skips it
+            store["events"][event['id']] = event
+            changed[event['id']] = event
+    # Without a sync token (shouldn't happen) the next call simply does another full sync
+    store["sync_token"] = sync.get("next_sync_token")
+
+    # Forget about events that have already started
+    today = now_dt_utc.date().isoformat()
+    def has_started(start):
+        if 'dateTime' in start:
+            return parse_event_time(start['dateTime']) < now_dt_utc
+        return start.get('date', today) < today  # all-day events
+    for event_id, event in list(store["events"].items()):
+        if event.get('recurrence'):
+            continue  # a series that started in the past still has instances to come
+        if store["expanded"] and 'recurringEventId' in event:
+            # A moved instance also stands in for its original slot, which the series would bring back
+            # without it: keep it until both have passed
+            starts = [start for start in (event.get('start'), event.get('originalStartTime')) if start]
+        else:
+            starts = [event.get('start') or event.get('originalStartTime', {})]
+        if all(has_started(start) for start in starts):
+            del store["events"][event_id]
+            changed.pop(event_id, None)
+            removed.add(event_id)
+
+    save_calendar(email, calendar_id, store, changed, removed, full_sync)
+
+@functools.lru_cache(maxsize=4096)
+def parse_event_time(value):
+    # Much faster than strptime, and the same start times get parsed on every poll.
+    # fromisoformat() only understands 'Z' from python 3.11 on.
+    if value.endswith('Z'):
+        value = value[:-1] + '+00:00'
+    return datetime.datetime.fromisoformat(value).astimezone(pytz.utc)
+
+def open_event_db(file_path=EVENT_DB_FILE):
+    # The events and sync tokens are also kept on disk, so that after a restart the triggers
+    # work straight away (even without a network connection) and only the changes are fetched
+    global event_db
+    try:
+        event_db = sqlite3.connect(file_path, check_same_thread=False)
+        with event_db_lock, event_db:
+            event_db.execute("CREATE TABLE IF NOT EXISTS calendars (email TEXT, calendar_id TEXT, sync_token TEXT, window_end TEXT, PRIMARY KEY (email, calendar_id))")
+            columns = [column[1] for column in event_db.execute("PRAGMA table_info(calendars)")]
+            if 'window_end' not in columns:
+                event_db.execute("ALTER TABLE calendars ADD COLUMN window_end TEXT")
+            if 'expanded' not in columns:
+                event_db.execute("ALTER TABLE calendars ADD COLUMN expanded INTEGER")
+            event_db.execute("CREATE TABLE IF NOT EXISTS events (email TEXT, calendar_id TEXT, event_id TEXT, event TEXT, PRIMARY KEY (email, calendar_id, event_id))")
+    except sqlite3.Error as e:
+        store_log.warning("⚠️  Could not open the event store %s, events will not be kept across restarts: %s", file_path, e)
+        event_db = None
+
+def load_event_store():
+    # Fill event_store and account_events from disk
+    if event_db is None:
+        return
+    with event_db_lock:
+        calendars = event_db.execute("SELECT email, calendar_id, sync_token, window_end, expanded FROM calendars").fetchall()
+        rows = event_db.execute("SELECT email, calendar_id, event FROM events").fetchall()
+    for email, calendar_id, sync_token, window_end, expanded in calendars:
+        event_store[(email, calendar_id)] = {"events": {}, "sync_token": sync_token, "window_end": window_end, "expanded": bool(expanded)}
+    for email, calendar_id, event_json in rows:
+        event = json.loads(event_json)
+        event_store.setdefault((email, calendar_id), {"events": {}, "sync_token": None, "window_end": None, "expanded": False})["events"][event['id']] = event
+    for email in email_addresses:
+        account_events[email] = accepted_meetings(email, stored_events(email))
+    store_log.info("📂 Loaded %d events from %s", len(rows), EVENT_DB_FILE)
+
+def forget_calendar(email, calendar_id):
+    # The calendar is no longer selected
+    event_store.pop((email, calendar_id), None)
+    if event_db is None:
+        return
+    with event_db_lock, event_db:
+        event_db.execute("DELETE FROM events WHERE email = ? AND calendar_id = ?", (email, calendar_id))
+        event_db.execute("DELETE FROM calendars WHERE email = ? AND calendar_id = ?", (email, calendar_id))
+
+def save_calendar(email, calendar_id, store, changed, removed, full_sync):
+    # Write what changed in one calendar to disk
+    if event_db is None:
+        return
+    try:
+        with event_db_lock, event_db:
+            if full_sync:
+                event_db.execute("DELETE FROM events WHERE email = ? AND calendar_id = ?", (email, calendar_id))
+            elif removed:
+                event_db.executemany("DELETE FROM events WHERE email = ? AND calendar_id = ? AND event_id = ?",
+                                     [(email, calendar_id, event_id) for event_id in removed])
+            event_db.executemany("INSERT OR REPLACE INTO events (email, calendar_id, event_id, event) VALUES (?, ?, ?, ?)",
+                                 [(email, calendar_id, event_id, json.dumps(event)) for event_id, event in changed.items()])
+            event_db.execute("INSERT OR REPLACE INTO calendars (email, calendar_id, sync_token, window_end, expanded) VALUES (?, ?, ?, ?, ?)",
+                             (email, calendar_id, store["sync_token"], store["window_end"], store.get("expanded", False)))
+    except sqlite3.Error as e:
+        store_log.warning("⚠️  Could not save events to %s: %s", EVENT_DB_FILE, e)
+
+def register_push_channel(email, calendar_id):
+    # Ask Google to POST to our webhook whenever the calendar changes
+    account_creds = get_credentials(email)
+    if not account_creds:
+        return
+    service = get_calendar_service(email, account_creds)
+    channel_id = str(uuid.uuid4())
+    body = {
+        "id": channel_id,
+        "type": "web_hook",
+        "address": push["address"],
+        "token": push_token,
+        "params": {"ttl": str(PUSH_CHANNEL_TTL_SECONDS)}
+    }
+    with account_locks.setdefault(email, threading.Lock()):
+        response = service.events().watch(calendarId=calendar_id, body=body).execute()
+    expiration = datetime.datetime.fromtimestamp(int(response['expiration']) / 1000, pytz.utc)
+    push_channels[channel_id] = {"email": email, "calendar_id": calendar_id,
+                                 "resource_id": response['resourceId'], "expiration": expiration}
+    push_log.debug("Push channel %s registered for %s (%s), expires %s", channel_id, email, calendar_id, expiration, extra={"account": email})
+
+def stop_push_channel(channel_id):
+    channel = push_channels.pop(channel_id)
+    account_creds = get_credentials(channel["email"])
+    if not account_creds:
+        return
+    service = get_calendar_service(channel["email"], account_creds)
+    try:
+        with account_locks.setdefault(channel["email"], threading.Lock()):
+            service.channels().stop(body={"id": channel_id, "resourceId": channel["resource_id"]}).execute()
+    except Exception as e:
+        push_log.debug("Could not stop push channel %s: %s", channel_id, e)
+
+def renew_push_channels():
+    # Runs on the scheduler: make sure every calendar has a channel that isn't about to expire
+    renew_before = datetime.datetime.now(pytz.utc) + datetime.timedelta(seconds=PUSH_RENEW_MARGIN_SECONDS)
+    for email in email_addresses:
+        with timed_lock(account_locks.setdefault(email, threading.Lock()), "account"):
+            calendar_ids = account_calendars(email)
+        for calendar_id in calendar_ids:
+            channels = [channel_id for channel_id, channel in list(push_channels.items())
+                        if channel["email"] == email and channel["calendar_id"] == calendar_id]
+            if any(push_channels[channel_id]["expiration"] > renew_before for channel_id in channels):
+                continue
+            try:
+                register_push_channel(email, calendar_id)
+            except Exception as e:
+                push_log.error("❌  ERROR: could not register push notifications for %s (%s): %s", email, calendar_id, e, extra={"account": email})
+                continue
+            for channel_id in channels:
+                stop_push_channel(channel_id)
+
+def handle_push_notification(headers):
+    # Returns the (email, calendar_id) that changed, or None if there is nothing to fetch
+    channel = push_channels.get(headers.get('X-Goog-Channel-ID'))
+    if channel is None or headers.get('X-Goog-Channel-Token') != push_token:
+        # e.g. a channel from before a restart, it will expire by itself
+        return None
+    if headers.get('X-Goog-Resource-State') == 'sync':
+        return None  # sent once when the channel is created
+    return channel["email"], channel["calendar_id"]
+
+def on_calendar_changed(email, calendar_id):
+    # Incremental fetch of only the calendar that changed
+    push_log.debug("Push notification for %s (%s)", email, calendar_id, extra={"account": email})
+    now = clock.now().isoformat().replace('+00:00', 'Z')
+    future = poll_executor.submit(poll_account, email, now, [calendar_id])
+    future.add_done_callback(lambda future: publish_upcoming())
+
+def start_push_receiver(port, on_change, host=''):
+    # Small embedded HTTP server that receives Google's push notifications
+    class PushNotificationHandler(http.server.BaseHTTPRequestHandler):
+        def do_POST(self):
+            length = int(self.headers.get('Content-Length') or 0)
+            if length:
+                self.rfile.read(length)
+            changed = handle_push_notification(self.headers)
+            self.send_response(200)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            if changed:
+                on_change(*changed)
+
+        def log_message(self, format, *args):
+            push_log.debug("Push receiver: " + format, *args)
+
+    server = http.server.ThreadingHTTPServer((host, port), PushNotificationHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+def test_push_receiver():
+    # Send a fake notification to a local receiver and check that it asks for the right calendar
+    changes = []
+    received = threading.Event()
+    server = start_push_receiver(0, lambda email, calendar_id: (changes.append((email, calendar_id)), received.set()), host='127.0.0.1')
+    channel_id = str(uuid.uuid4())
+    push_channels[channel_id] = {"email": "test@example.com", "calendar_id": "primary", "resource_id": "test",
+                                 "expiration": datetime.datetime.now(pytz.utc)}
+    request = urllib.request.Request(f"http://127.0.0.1:{server.server_address[1]}/", data=b'', method='POST', headers={
+        'X-Goog-Channel-ID': channel_id,
+        'X-Goog-Channel-Token': push_token,
+        'X-Goog-Resource-State': 'exists',
+        'X-Goog-Resource-ID': 'test'
+    })
+    try:
+        start = time.perf_counter()
+        urllib.request.urlopen(request, timeout=5).read()
+        received.wait(5)
+        print(f"    Notification handled in {(time.perf_counter() - start) * 1000:.1f} ms")
+        if changes == [("test@example.com", "primary")]:
+            print("    ✅ Push receiver asked for an incremental fetch of the right calendar.")
+        else:
+            print(f"    ❌ Push receiver asked for {changes}")
+    except Exception as e:
+        print(f"    ❌  ERROR: could not reach the push receiver: {e}")
+    finally:
+        push_channels.pop(channel_id, None)
+        server.shutdown()
+
+class Metrics:
+    # Counters, gauges and histograms, exposed in Prometheus text format on the metrics endpoint
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}  # (name, labels) -> value
+        self.gauges = {}  # (name, labels) -> value
+        self.histograms = {}  # (name, labels) -> [count per bucket..., sum, count]
+        self.buckets = {}  # name -> bucket upper bounds
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        with self.lock:
+            self.gauges[(name, tuple(sorted(labels.items())))] = value
+
+    def observe(self, name, value, buckets=DURATION_BUCKETS, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.buckets.setdefault(name, buckets)
+            histogram = self.histograms.setdefault(key, [0] * len(buckets) + [0.0, 0])
+            for i, bound in enumerate(self.buckets[name]):
+                if value <= bound:
+                    histogram[i] += 1
+            histogram[-2] += value
+            histogram[-1] += 1
+
+    def render(self):
+        # Prometheus text exposition format
+        lines = []
+        with self.lock:
+            for kind, values in (("counter", self.counters), ("gauge", self.gauges)):
+                for name in sorted({name for name, labels in values}):
+                    lines.append(f"# TYPE {name} {kind}")
+                    for (metric, labels), value in sorted(values.items()):
+                        if metric == name:
+                            lines.append(f"{name}{format_labels(labels)} {value}")
+            for name in sorted({name for name, labels in self.histograms}):
+                lines.append(f"# TYPE {name} histogram")
+                for (metric, labels), histogram in sorted(self.histograms.items()):
+                    if metric != name:
+                        continue
+                    for bound, count in zip(self.buckets[name], histogram):
+                        lines.append(f"{name}_bucket{format_labels(labels + (('le', bound),))} {count}")
+                    lines.append(f"{name}_bucket{format_labels(labels + (('le', '+Inf'),))} {histogram[-1]}")
+                    lines.append(f"{name}_sum{format_labels(labels)} {histogram[-2]}")
+                    lines.append(f"{name}_count{format_labels(labels)} {histogram[-1]}")
+        return "\n".join(lines) + "\n"
+
+    def summary(self):
+        # Human readable version for --stats, with percentiles estimated from the buckets
+        lines = []
+        with self.lock:
+            for (name, labels), value in sorted(list(self.counters.items()) + list(self.gauges.items())):
+                lines.append(f"{name}{format_labels(labels)}: {value:g}")
+            for (name, labels), histogram in sorted(self.histograms.items()):
+                count = histogram[-1]
+                if not count:
+                    continue
+                percentiles = ", ".join(f"p{int(q * 100)} {bucket_quantile(q, self.buckets[name], histogram) * 1000:.0f} ms"
+                                        for q in (0.5, 0.95, 0.99))
+                lines.append(f"{name}{format_labels(labels)}: {count} samples, avg {histogram[-2] / count * 1000:.0f} ms, {percentiles}")
+        return "\n".join(lines)
 
+metrics = Metrics()
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{escape_label(value)}"' for key, value in labels) + "}"
+
+def escape_label(value):
+    # Label values come from outside too (e.g. Hue sensor names), the text format only escapes these three
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def bucket_quantile(q, bounds, histogram):
+    # Linear interpolation within the bucket that holds the q-th sample, like Prometheus' histogram_quantile
+    rank = q * histogram[-1]
+    previous_bound, previous_count = min(bounds[0], 0), 0
+    for bound, count in zip(bounds, histogram):
+        if count >= rank:
+            if count == previous_count:
+                return bound
+            return previous_bound + (bound - previous_bound) * (rank - previous_count) / (count - previous_count)
+        previous_bound, previous_count = bound, count
+    return bounds[-1]
+
+@contextlib.contextmanager
+def timed_lock(lock_to_take, name):
+    # Takes the lock, and records how long we had to wait for it
+    start = time.perf_counter()
+    with lock_to_take:
+        metrics.observe("calendar_chime_lock_wait_seconds", time.perf_counter() - start, lock=name)
+        yield
+
+def start_metrics_server(port, host='127.0.0.1'):
+    # /metrics for Prometheus, /stats for --stats
+    class MetricsHandler(http.server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            update_gauges()
+            if self.path == '/metrics':
+                body = metrics.render().encode()
+                content_type = 'text/plain; version=0.0.4'
+            elif self.path == '/stats':
+                body = metrics.summary().encode()
+                content_type = 'text/plain; charset=utf-8'
+            else:
+                self.send_error(404)
+                return
+            self.send_response(200)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = http.server.ThreadingHTTPServer((host, port), MetricsHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+def update_gauges():
+    metrics.set("calendar_chime_poll_interval_seconds", effective_poll_interval)
+    metrics.set("calendar_chime_upcoming_meetings", len(upcoming))
+    with trigger_condition:
+        metrics.set("calendar_chime_pending_triggers", len(pending_triggers))
+    for action in trigger_actions:
+        metrics.set("calendar_chime_action_latency_seconds", action.latency or 0.0, action=action.name)
+
+def print_stats(port):
+    # Ask the running script for its statistics
+    try:
+        with urllib.request.urlopen(f"http://127.0.0.1:{port}/stats", timeout=5) as response:
+            print(response.read().decode())
+    except Exception as e:
+        print(f"    ❌  ERROR: could not get the statistics from port {port}, is the script running? ({e})")
+
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+    # Hands the record over as it is: formatting (and writing) happens on the listener thread,
+    # so a log call on the trigger path costs a queue put, whatever stdout is connected to
+    def prepare(self, record):
+        return record
+
+class LogFormatter(logging.Formatter):
+    # "text" prints just the message, like the script always did. "json" and "logfmt" print one
+    # record per line with the time, level, subsystem and any extra fields (account, event_id, ...)
+    def __init__(self, style="text"):
+        super().__init__()
+        self.style = style
+
+    def format(self, record):
+        message = record.getMessage()
+        if record.exc_info:
+            message += "\n" + self.formatException(record.exc_info)
+        suppressed = getattr(record, "suppressed", 0)
+        if self.style == "text":
+            return message + (f" ({suppressed} similar messages suppressed)" if suppressed else "")
+        fields = {
+            "time": datetime.datetime.fromtimestamp(record.created, pytz.utc).isoformat(timespec='milliseconds').replace('+00:00', 'Z'),
+            "level": record.levelname.lower(),
+            "logger": record.name.partition('.')[2] or record.name,
+            "message": message,
+        }
+        fields.update((key, value) for key, value in record.__dict__.items() if key not in STANDARD_RECORD_FIELDS)
+        if self.style == "json":
+            return json.dumps(fields, default=str, ensure_ascii=False)
+        return " ".join(f"{key}={logfmt_value(value)}" for key, value in fields.items())
+
+def logfmt_value(value):
+    value = str(value)
+    if value and not any(c in value for c in ' "=\n'):
+        return value
+    return json.dumps(value, ensure_ascii=False)
+
+class RateLimitFilter(logging.Filter):
+    # Lets through at most per_minute records of each message (per subsystem), the next one that gets
+    # through says how many were dropped. Runs on the listener thread, like the formatting
+    def __init__(self, per_minute):
+        super().__init__()
+        self.per_minute = per_minute
+        self.windows = {}  # (logger, message template) -> [start of the minute, records let through, records suppressed]
+
+    def filter(self, record):
+        if not self.per_minute:
+            return True
+        window = self.windows.setdefault((record.name, record.msg), [record.created, 0, 0])
+        if record.created - window[0] >= 60:
+            window[0], window[1] = record.created, 0
+        if window[1] >= self.per_minute:
+            window[2] += 1
+            return False
+        window[1] += 1
+        record.suppressed, window[2] = window[2], 0
+        return True
+
+def setup_logging(verbose=False, background=True):
+    # Log records go through a queue to a listener thread that writes them, so neither the trigger
+    # thread nor a poll ever waits for a slow stdout. Without background (--simulate), records are
+    # written straight away to keep them in order with the printed output
+    global log_listener, log_rate_limit, verbose_logging
+    verbose_logging = verbose
+    log_rate_limit = RateLimitFilter(0)
+    log_handler.addFilter(log_rate_limit)
+    log.propagate = False
+    if background:
+        log_listener = logging.handlers.QueueListener(log_queue, log_handler, respect_handler_level=True)
+        log_listener.start()
+        atexit.register(log_listener.stop)
+        log.addHandler(DeferredQueueHandler(log_queue))
+    else:
+        log.addHandler(log_handler)
+    configure_logging(config.logging if config else {})
+
+def configure_logging(settings):
+    # Apply the "logging" settings, see compile_config(). Also runs when settings.json changes
+    log_handler.setFormatter(LogFormatter(settings.get("format", "text")))
+    if log_rate_limit:
+        log_rate_limit.per_minute = settings.get("rate_limit_per_minute", 0)
+    log.setLevel(logging.DEBUG if verbose_logging else settings.get("level", "INFO"))
+    levels = settings.get("levels", {})
+    for subsystem in LOG_SUBSYSTEMS:
+        logging.getLogger(f"calendar_chime.{subsystem}").setLevel(levels.get(subsystem, logging.NOTSET))
+
+def simulate(file_path):
+    # Replays a timeline of calendar snapshots through publish_upcoming() and continuous_event_check()
+    # on a virtual clock that jumps from one poll, snapshot or trigger to the next, so a month of
+    # meetings takes seconds. The actions only print when they would have gone off.
+    global clock, action_executor, email_addresses, lookahead_hours, rooms
+    with open(file_path, 'r') as file:
+        timeline = json.load(file)
+    snapshots = sorted(((parse_event_time(snapshot["at"]), snapshot) for snapshot in timeline["snapshots"]), key=lambda snapshot: snapshot[0])
+    for at, snapshot in snapshots:
+        for event in snapshot["events"]:
+            event.setdefault("eventType", "default")
+            event.setdefault("summary", event["id"])
+    start = parse_event_time(timeline["start"]) if "start" in timeline else snapshots[0][0]
+    if "end" in timeline:
+        end = parse_event_time(timeline["end"])
+    else:
+        # until the last meeting in the timeline has started
+        end = max([at for at, snapshot in snapshots] +
+                  [start_dt_utc for at, snapshot in snapshots for start_dt_utc, event in accepted_meetings(snapshot["email"], snapshot["events"], at)])
+        end += datetime.timedelta(minutes=1)
+    lookahead_hours = timeline.get("lookahead_hours", lookahead_hours)
+    email_addresses = sorted({snapshot["email"] for at, snapshot in snapshots})
+
+    fired = []
+    def simulated_action(name):
+        def run(event, timeout):
+            now = clock.now()
+            fired.append(name)
+            seconds_before = (parse_event_time(event["start"]["dateTime"]) - now).total_seconds()
+            print(f"{now.isoformat(timespec='milliseconds').replace('+00:00', 'Z')}  {name:<8} {event_title(event)} (starts in {seconds_before:.1f}s)")
+        return TriggerAction(name, run)
+
+    clock = VirtualClock(start.timestamp(), speed=0)
+    action_executor = InlineExecutor()
+    room = Room("", email_addresses, lighting, midi, False, False)
+    room.actions = [simulated_action(name) for name in timeline.get("actions", ["chime", "lights"])]
+    rooms = [room]
+    trigger_actions[:] = room.actions
+    threading.Thread(target=continuous_event_check, daemon=True).start()
+    clock.advance(0)
+
+    print(f"🎬 Simulating {start.isoformat()} to {end.isoformat()} ({len(snapshots)} snapshots, {len(email_addresses)} accounts)")
+    real_start = time.perf_counter()
+    next_snapshot = 0
+    snapshot_events = {}  # email -> events of its latest snapshot
+    next_poll = clock.time()
+    polls = 0
     while True:
-        with lock:
-            now = datetime.datetime.now(pytz.utc)
-            if next_event:
-                time_diff = (next_start_time - now).total_seconds()
-                if 0 <= time_diff <= warning_time_seconds:
-                    if not event_triggered:
-                        print(f'🔔🎥 {next_event["summary"]} is starting now! 🎥🔔')
-                        if play_sound:
-                            try:
-                                bong(1, midi.get("device"), midi.get("channel"), midi.get("note"), midi.get("duration"))
-                            except Exception as e:
-                                print(f'❌  ERROR: could not play a sound: {e}')
-                        if change_lights:
-                            if lighting.get("use_ha"):
-                                # activate HA scene
-                                import requests
-                                url = f"{lighting['ha_url']}/api/services/scene/turn_on"
-                                headers = {
-                                    "Authorization": f"Bearer {lighting['ha_token']}",
-                                    "Content-Type": "application/json"
-                                }
-                                payload = {"entity_id": lighting['ha_scene_id']}
-                                response = requests.post(url, headers=headers, json=payload)
-                                if response.status_code == 200:
-                                    print("Home Assistant scene activated successfully.")
-                                else:
-                                    print(f"Failed to activate Home Assistant scene: {response.text}")
-                            else:
-                                try:
-                                    # activate hue scene
-                                    hue_bridge.activate_scene(1, lighting.get("hue_scene_id"), 0)
-                                except Exception as e:
-                                    print(f'❌  ERROR: could not turn the lights on: {e}')
-                        else:
-                            if verbose: print(f"❌  ERROR: no hue bridge scene ID")
-                        event_triggered = True  # Set the flag to indicate the event action has been triggered
-                    else:
-                        if (debug): print('event already triggered')
-                elif time_diff < 2:
-                    # if we are past the warning window, clear the event
-                    next_event = None
-                    next_start_time = None
-                    event_triggered = False  # Reset the trigger flag
-                else:
-                    if (debug): print(f"Event '{next_event['summary']}' is not yet within the time window ({warning_time_seconds}s).")
+        now = clock.time()
+        while next_snapshot < len(snapshots) and snapshots[next_snapshot][0].timestamp() <= now:
+            snapshot = snapshots[next_snapshot][1]
+            snapshot_events[snapshot["email"]] = snapshot["events"]
+            next_snapshot += 1
+            next_poll = now  # the poll that would have seen the change
+        if next_poll <= now:
+            # like fetch_account_events(), every poll expands the recurring events over the window from now on
+            for email, events in snapshot_events.items():
+                account_events[email] = accepted_meetings(email, events)
+            publish_upcoming()
+            update_poll_interval()
+            clock.advance(0)
+            polls += 1
+            next_poll = now + effective_poll_interval
+
+        with trigger_condition:
+            next_trigger = pending_triggers[0][0] - clock.monotonic() + now if pending_triggers else None
+        next_times = [next_poll]
+        if next_snapshot < len(snapshots):
+            next_times.append(snapshots[next_snapshot][0].timestamp())
+        if next_trigger is not None:
+            next_times.append(next_trigger)
+        if min(next_times) > end.timestamp():
+            break
+        clock.advance(max(min(next_times) - now, 0))
+
+    elapsed = time.perf_counter() - real_start
+    days = (end - start).total_seconds() / 86400
+    print(f"🎬 Simulated {days:.1f} days in {elapsed:.2f}s: {len(fired)} actions fired, {polls} polls "
+          f"({(len(fired) + polls) / elapsed:.0f} per second)")
+
+class TriggerAction:
+    # Something that happens when a meeting is about to start: the chime, the lights, ...
+    # Each action is fired early by its measured latency (up to its latency budget), so that
+    # they all take effect at the same time, WARNING_TIME_SECONDS before the meeting.
+    def __init__(self, name, run, timeout=ACTION_TIMEOUT_SECONDS, latency_budget=ACTION_LATENCY_BUDGET_SECONDS, prewarm=None):
+        self.name = name
+        self.run = run  # run(event, timeout)
+        self.prewarm = prewarm  # prewarm(event, timeout), called PREWARM_SECONDS before the action, e.g. to open a connection
+        self.timeout = timeout
+        self.latency_budget = latency_budget
+        self.latency = None  # moving average of how long the action takes, in seconds
+
+    def lead_time(self):
+        return min(self.latency or 0.0, self.latency_budget)
+
+    def record_latency(self, seconds):
+        self.latency = seconds if self.latency is None else 0.7 * self.latency + 0.3 * seconds
+
+class Room:
+    # The accounts whose meetings are announced in one place, and the chime and lights that announce them.
+    # Normally there is one Room, made from settings.json; with --rooms there is one per settings file.
+    def __init__(self, name, email_addresses, lighting, midi, play_sound, change_lights, hue_bridge=None):
+        self.name = name  # empty for the single room
+        self.email_addresses = email_addresses
+        self.lighting = lighting
+        self.midi = midi
+        self.play_sound = play_sound
+        self.change_lights = change_lights
+        self.hue_bridge = hue_bridge
+        self.upcoming = ()  # like upcoming, but only the meetings of this room's accounts
+        self.actions = []  # TriggerActions, see setup_trigger_actions()
+
+    def action_name(self, name):
+        return f"{self.name}/{name}" if self.name else name
+
+def single_room():
+    # The room described by settings.json
+    return Room("", email_addresses, lighting, midi, play_sound, change_lights, hue_bridge)
+
+def load_room(file_path):
+    # A room's settings file looks like settings.json (its process wide settings are ignored)
+    room_config = read_config(file_path)
+    name = os.path.splitext(os.path.basename(file_path))[0]
+    return Room(name, room_config.email_addresses, room_config.lighting, room_config.midi, room_config.play_sound, room_config.change_lights)
+
+def load_rooms(directory, previous=()):
+    # One room per .json file in the directory, named after the file. Rooms in `previous` whose file
+    # didn't change are kept as they are, and a room whose file is broken keeps its previous version.
+    kept = {room.name: room for room in previous}
+    loaded = []
+    for file_name in sorted(os.listdir(directory)):
+        if not file_name.endswith('.json'):
+            continue
+        file_path = os.path.join(directory, file_name)
+        name = os.path.splitext(file_name)[0]
+        mtime = os.stat(file_path).st_mtime_ns
+        if name in kept and settings_mtimes.get(file_path) == mtime:
+            loaded.append(kept[name])
+            continue
+        settings_mtimes[file_path] = mtime
+        try:
+            loaded.append(load_room(file_path))
+        except Exception as e:
+            settings_log.error("❌  ERROR: %s room %s: %s", 'keeping the previous settings of' if name in kept else 'skipping', file_name, e)
+            if name in kept:
+                loaded.append(kept[name])
+    return loaded
+
+def reload_rooms(directory):
+    # Runs on the scheduler: switch to changed, new and deleted room files without a restart
+    global rooms, email_addresses
+    files = {os.path.join(directory, file_name) for file_name in os.listdir(directory) if file_name.endswith('.json')}
+    if files == {file_path for file_path in settings_mtimes if os.path.dirname(file_path) == directory.rstrip('/')} and \
+            all(os.stat(file_path).st_mtime_ns == settings_mtimes[file_path] for file_path in files):
+        return
+    for file_path in set(settings_mtimes) - files:
+        if os.path.dirname(file_path) == directory.rstrip('/'):
+            del settings_mtimes[file_path]
+    new_rooms = load_rooms(directory, rooms)
+    if [id(room) for room in new_rooms] == [id(room) for room in rooms]:
+        return
+    settings_log.info("🏢 Rooms changed, now %d rooms", len(new_rooms))
+    old_devices = midi_devices()
+    old_emails = email_addresses
+    rooms = new_rooms
+    email_addresses = tuple(sorted({email for room in rooms for email in room.email_addresses}))
+    connect_room_bridges()
+    check_hue_scenes()
+    update_midi_devices(old_devices)
+    setup_trigger_actions()
+    update_accounts(old_emails)
+
+def connect_room_bridges():
+    # Rooms on the same Hue bridge share one connection to it
+    bridges = {room.lighting.get("hue_bridge_ip_address"): room.hue_bridge for room in rooms if room.hue_bridge is not None}
+    for room in rooms:
+        if not (room.change_lights and room.lighting.get("use_hue")) or room.hue_bridge is not None:
+            continue
+        ip_address = room.lighting.get("hue_bridge_ip_address")
+        if ip_address not in bridges:
+            import phue  # only Hue rooms load it
+            try:
+                bridges[ip_address] = phue.Bridge(ip_address, username=room.lighting.get("hue_username"))
+                bridges[ip_address].connect()
+                lights_log.info("Successfully connected to the Hue bridge (%s).", ip_address)
+            except Exception as e:
+                lights_log.error("Failed to connect to the Hue bridge %s, the lights in %s won't change: %s", ip_address, room.name, e)
+                bridges[ip_address] = None
+        room.hue_bridge = bridges[ip_address]
+        room.change_lights = room.hue_bridge is not None
+
+def setup_trigger_actions():
+    # Build the list of actions of each room from its settings, keeping what we learnt about their latency
+    latencies = {action.name: action.latency for action in trigger_actions}
+    for room in rooms:
+        actions = [TriggerAction(room.action_name("announce"), functools.partial(announce_meeting, room))]
+        if room.play_sound:
+            actions.append(TriggerAction(room.action_name("chime"), functools.partial(play_chime, room)))
+        if room.change_lights:
+            if room.lighting.get("use_ha"):
+                actions.append(TriggerAction(room.action_name("lights"), functools.partial(activate_ha_scene, room),
+                                             prewarm=functools.partial(prewarm_ha, room)))
             else:
-                if (debug): print("No upcoming event found.")
-        time.sleep(1)  # Check every second
+                actions.append(TriggerAction(room.action_name("lights"), functools.partial(activate_hue_scene, room),
+                                             prewarm=functools.partial(prewarm_hue, room)))
+        else:
+            lights_log.debug("❌  ERROR: no hue bridge scene ID")
+        for action in actions:
+            action.latency = latencies.get(action.name)
+        room.actions = actions
+    trigger_actions[:] = [action for room in rooms for action in room.actions]
+
+def arm_triggers():
+    # Replace the scheduled triggers with one per UpcomingEvent and action of each room, and wake up the trigger thread.
+    # Called by publish_upcoming() with the lock held
+    now, now_mono = clock.time(), clock.monotonic()
+    triggers = []
+    for room in rooms:
+        for upcoming_event in room.upcoming:
+            for action in room.actions:
+                fire_at = upcoming_event.start_time.timestamp() - WARNING_TIME_SECONDS - action.lead_time()
+                key = (upcoming_event.event.get('iCalUID', upcoming_event.event['id']), upcoming_event.start_time, action.name)
+                trigger = Trigger(fire_at, key, upcoming_event, action, False)
+                triggers.append((now_mono + fire_at - now, key, trigger))
+                if action.prewarm:
+                    prewarm_key = key + ('prewarm',)
+                    trigger = Trigger(fire_at - PREWARM_SECONDS, prewarm_key, upcoming_event, action, True)
+                    triggers.append((now_mono + trigger.fire_at - now, prewarm_key, trigger))
+    heapq.heapify(triggers)
+    with timed_lock(trigger_condition, "triggers"):
+        pending_triggers[:] = triggers
+        # forget triggers of meetings that have started
+        fired_triggers.intersection_update(key for deadline, key, trigger in triggers)
+        trigger_condition.notify()
+
+def rearm_triggers(now, now_mono):
+    # Recompute the monotonic deadlines from the wall clock, e.g. after the computer was asleep
+    triggers = [(now_mono + trigger.fire_at - now, key, trigger) for deadline, key, trigger in pending_triggers]
+    heapq.heapify(triggers)
+    pending_triggers[:] = triggers
+
+def continuous_event_check():
+    trigger_log.debug("Continuous event check started")
+    last_wall, last_mono = clock.time(), clock.monotonic()
+
+    while True:
+        with trigger_condition:
+            now, now_mono = clock.time(), clock.monotonic()
+            # The monotonic clock doesn't run while the computer is asleep, the wall clock does
+            clock_jump = (now - last_wall) - (now_mono - last_mono)
+            if abs(clock_jump) > SLEEP_DETECTION_SECONDS:
+                trigger_log.warning("⏰ Clock jumped by %.0fs (was the computer asleep?), re-arming meeting triggers", clock_jump)
+                rearm_triggers(now, now_mono)
+            last_wall, last_mono = now, now_mono
+
+            due = []
+            while pending_triggers and pending_triggers[0][0] <= now_mono:
+                due.append(heapq.heappop(pending_triggers)[2])
+            if not due:
+                # Sleep until the next trigger is due, or until arm_triggers wakes us up
+                timeout = MAX_TIMER_WAIT_SECONDS
+                if pending_triggers:
+                    timeout = min(timeout, pending_triggers[0][0] - now_mono)
+                    trigger_log.debug("Next trigger in %.1fs", pending_triggers[0][0] - now_mono)
+                clock.wait(trigger_condition, timeout)
+                continue
+            due = [trigger for trigger in due if trigger.key not in fired_triggers]
+            fired_triggers.update(trigger.key for trigger in due)
+
+        missed = set()
+        for trigger in due:
+            # This thread fires every trigger, so one bad event must not stop it
+            try:
+                dispatch_trigger(trigger, missed)
+            except Exception as e:
+                trigger_log.exception("❌  ERROR: could not fire %s for event %s: %s", trigger.action.name, trigger.upcoming_event.event.get('id'), e)
+
+def dispatch_trigger(trigger, missed):
+    time_diff = (trigger.upcoming_event.start_time.timestamp() - clock.time())
+    if trigger.prewarm:
+        if time_diff >= 0:
+            action_executor.submit(run_prewarm, trigger)
+        return
+    if time_diff < 0:
+        # Only happens when we were asleep (or busy) while the trigger was due
+        if trigger.key[:2] not in missed:
+            trigger_log.warning("⏰ Missed the trigger for '%s', it started %.0fs ago", event_title(trigger.upcoming_event.event), -time_diff,
+                                extra={"event_id": trigger.upcoming_event.event['id'], "account": trigger.upcoming_event.email})
+            missed.add(trigger.key[:2])
+        return
+    # All actions run in parallel, so a slow one can't hold up the others
+    metrics.observe("calendar_chime_timer_lateness_seconds", clock.time() - trigger.fire_at, buckets=LATENESS_BUCKETS)
+    action_executor.submit(run_action, trigger)
+
+def run_action(trigger):
+    action = trigger.action
+    start = time.monotonic()
+    try:
+        action.run(trigger.upcoming_event.event, action.timeout)
+    except Exception as e:
+        action_log.error('❌  ERROR: %s action failed: %s', action.name, e, extra={"action": action.name, "event_id": trigger.upcoming_event.event['id']})
+        metrics.inc("calendar_chime_actions_total", action=action.name, result="error")
+        return
+    latency = time.monotonic() - start
+    # How late the action took effect, compared to WARNING_TIME_SECONDS before the meeting
+    intended = trigger.upcoming_event.start_time.timestamp() - WARNING_TIME_SECONDS
+    metrics.observe("calendar_chime_trigger_lateness_seconds", clock.time() - intended, buckets=LATENESS_BUCKETS, action=action.name)
+    metrics.inc("calendar_chime_actions_total", action=action.name, result="ok")
+    action.record_latency(latency)
+    action_log.debug("%s action took %.0f ms (average %.0f ms)", action.name, latency * 1000, action.latency * 1000,
+                     extra={"action": action.name, "event_id": trigger.upcoming_event.event['id'], "latency_ms": round(latency * 1000, 1)})
+    if latency > action.latency_budget:
+        action_log.warning("⚠️  %s action took %.1fs, more than its latency budget of %ss", action.name, latency, action.latency_budget,
+                           extra={"action": action.name, "event_id": trigger.upcoming_event.event['id'], "latency_ms": round(latency * 1000, 1)})
+
+def run_prewarm(trigger):
+    try:
+        trigger.action.prewarm(trigger.upcoming_event.event, trigger.action.timeout)
+        action_log.debug("%s connection pre-warmed", trigger.action.name)
+    except Exception as e:
+        action_log.debug("Could not pre-warm the %s connection: %s", trigger.action.name, e)
+
+def announce_meeting(room, event, timeout):
+    if room.name:
+        action_log.info('🔔🎥 %s is starting now in %s! 🎥🔔', event_title(event), room.name, extra={"event_id": event['id'], "room": room.name})
+    else:
+        action_log.info('🔔🎥 %s is starting now! 🎥🔔', event_title(event), extra={"event_id": event['id']})
+
+def play_chime(room, event, timeout):
+    # Only writes the note_on to the open port, the note_off is sent by a timer, so there's nothing to time out
+    bong(1, room.midi.get("device"), room.midi.get("channel"), room.midi.get("note"), room.midi.get("duration"))
 
+def get_http_session(retries=True):
+    # Connection-pooled sessions for Home Assistant and the Hue bridge, so that a trigger can
+    # reuse a kept-alive connection instead of doing a new TCP/TLS handshake. The triggers (and
+    # their pre-warming, which opens the connection they reuse) get a session without retries,
+    # so that the action's timeout bounds how long it takes; background requests do retry.
+    global http_session, trigger_session
+    with http_session_lock:
+        if http_session is None:
+            from urllib3.util.retry import Retry
+            http_session = new_http_session(Retry(total=HTTP_RETRIES, connect=HTTP_RETRIES, read=1, backoff_factor=0.1,
+                                                  status_forcelist=(502, 503, 504), allowed_methods=None))
+            trigger_session = new_http_session(0)
+        return http_session if retries else trigger_session
+
+def new_http_session(retries):
+    import requests
+    from requests.adapters import HTTPAdapter
+    # one pool per Home Assistant or Hue host, so with many rooms keep one for each
+    hosts = {room.lighting.get("ha_url") or room.lighting.get("hue_bridge_ip_address") for room in rooms}
+    adapter = HTTPAdapter(pool_connections=max(4, len(hosts)), pool_maxsize=8, max_retries=retries)
+    session = requests.Session()
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+def trigger_timeout(timeout):
+    # (connect, read) timeouts that add up to an action's timeout
+    connect = min(HTTP_CONNECT_TIMEOUT_SECONDS, timeout / 2)
+    return (connect, timeout - connect)
+
+def ha_headers(room):
+    return {
+        "Authorization": f"Bearer {room.lighting['ha_token']}",
+        "Content-Type": "application/json"
+    }
+
+def activate_ha_scene(room, event, timeout):
+    url = f"{room.lighting['ha_url']}/api/services/scene/turn_on"
+    payload = {"entity_id": room.lighting['ha_scene_id']}
+    response = get_http_session(retries=False).post(url, headers=ha_headers(room), json=payload, timeout=trigger_timeout(timeout))
+    if response.status_code == 200:
+        lights_log.info("Home Assistant scene activated successfully.")
+    else:
+        raise RuntimeError(f"Failed to activate Home Assistant scene: {response.text}")
+
+def prewarm_ha(room, event, timeout):
+    # Open (or refresh) the connection to Home Assistant just before we need it
+    get_http_session(retries=False).get(f"{room.lighting['ha_url']}/api/", headers=ha_headers(room), timeout=trigger_timeout(timeout))
+
+def hue_url(room, path):
+    return f"http://{room.lighting.get('hue_bridge_ip_address')}/api/{room.hue_bridge.username}{path}"
+
+def activate_hue_scene(room, event, timeout):
+    payload = {"scene": room.lighting.get("hue_scene_id"), "transitiontime": 0}
+    response = get_http_session(retries=False).put(hue_url(room, '/groups/1/action'), json=payload, timeout=trigger_timeout(timeout))
+    errors = [item['error'].get('description') for item in response.json() if 'error' in item]
+    if errors:
+        # e.g. the scene was deleted: don't trust what we know about the bridge any more
+        hue_state(room.lighting.get("hue_bridge_ip_address"), room.hue_bridge.username).invalidate()
+        raise RuntimeError(f"Hue bridge error: {', '.join(errors)}")
+
+def prewarm_hue(room, event, timeout):
+    get_http_session(retries=False).get(hue_url(room, '/config'), timeout=trigger_timeout(timeout))
+
+class HueState:
+    # Everything a Hue bridge knows (lights, groups, scenes, sensors, ...) comes back from a single
+    # GET /api/<username>, so we fetch that and keep it for a while instead of asking per object
+    def __init__(self, ip_address, username):
+        self.ip_address = ip_address
+        self.username = username
+        self.lock = threading.Lock()  # held while fetching, so callers at the same time share one request
+        self.state = None
+        self.fetched = None  # monotonic time
+
+    def get(self, max_age=HUE_STATE_TTL_SECONDS, timeout=ACTION_TIMEOUT_SECONDS):
+        with self.lock:
+            if self.state is None or time.monotonic() - self.fetched > max_age:
+                start = time.perf_counter()
+                response = get_http_session().get(f"http://{self.ip_address}/api/{self.username}", timeout=(HTTP_CONNECT_TIMEOUT_SECONDS, timeout))
+                state = response.json()
+                metrics.observe("calendar_chime_hue_state_seconds", time.perf_counter() - start, bridge=self.ip_address)
+                if isinstance(state, list):  # errors, e.g. an unknown username, come back as a list
+                    raise RuntimeError(f"Hue bridge error: {', '.join(item['error'].get('description') for item in state if 'error' in item)}")
+                self.state, self.fetched = state, time.monotonic()
+            return self.state
+
+    def invalidate(self):
+        with self.lock:
+            self.state = None
+
+    def groups(self, max_age=HUE_STATE_TTL_SECONDS):
+        return self.get(max_age).get("groups", {})
+
+    def scenes(self, max_age=HUE_STATE_TTL_SECONDS):
+        return self.get(max_age).get("scenes", {})
+
+    def sensors(self, max_age=HUE_STATE_TTL_SECONDS):
+        return self.get(max_age).get("sensors", {})
+
+def hue_state(ip_address, username):
+    state = hue_states.get(ip_address)
+    if state is None or state.username != username:
+        state = hue_states[ip_address] = HueState(ip_address, username)
+    return state
+
+def room_hue_states():
+    # The HueState of each bridge the rooms change the lights with
+    return {room.lighting.get("hue_bridge_ip_address"): hue_state(room.lighting.get("hue_bridge_ip_address"), room.hue_bridge.username)
+            for room in rooms if room.change_lights and room.lighting.get("use_hue") and room.hue_bridge is not None}
+
+def check_hue_scenes():
+    # Make sure the scene of each room is on its bridge now, rather than finding out when a meeting starts.
+    # A room whose scene is missing doesn't change the lights, one whose bridge can't be reached is left as it is
+    for room in rooms:
+        if not (room.change_lights and room.lighting.get("use_hue") and room.hue_bridge is not None):
+            continue
+        ip_address, scene_id = room.lighting.get("hue_bridge_ip_address"), room.lighting.get("hue_scene_id")
+        state = hue_state(ip_address, room.hue_bridge.username)
+        try:
+            # the cached state can be older than the scene, so look again before giving up on it
+            if scene_id not in state.scenes() and scene_id not in state.scenes(max_age=0):
+                lights_log.error("❌  ERROR: Hue scene %s is not on the bridge %s, the lights%s won't change", scene_id, ip_address,
+                                 f" in {room.name}" if room.name else "", extra={"room": room.name})
+                room.change_lights = False
+        except Exception as e:
+            lights_log.warning("⚠️  Could not check the Hue scene %s on the bridge %s: %s", scene_id, ip_address, e)
+
+def check_sensor_batteries():
+    # Runs on the scheduler: warn once about each Hue sensor (motion sensor, switch, ...) whose battery is running low
+    for ip_address, state in room_hue_states().items():
+        try:
+            sensors = state.sensors()
+        except Exception as e:
+            lights_log.warning("⚠️  Could not check the sensor batteries on the Hue bridge %s: %s", ip_address, e)
+            continue
+        for sensor_id, sensor in sensors.items():
+            battery = sensor.get("config", {}).get("battery")
+            if battery is None:
+                continue
+            metrics.set("calendar_chime_hue_sensor_battery_percent", battery, bridge=ip_address, sensor=sensor.get("name", sensor_id))
+            if battery < LOW_BATTERY_PERCENT and (ip_address, sensor_id) not in low_batteries:
+                lights_log.warning('🔋🚨: %s battery is low (%d%%)', sensor.get("name"), battery, extra={"bridge": ip_address, "sensor": sensor_id})
+                low_batteries.add((ip_address, sensor_id))
+            elif battery >= LOW_BATTERY_PERCENT and (ip_address, sensor_id) in low_batteries:
+                lights_log.info('🔋: %s battery is fine again (%d%%)', sensor.get("name"), battery, extra={"bridge": ip_address, "sensor": sensor_id})
+                low_batteries.discard((ip_address, sensor_id))
+
+
+def midi_devices():
+    # The MIDI devices the rooms play their chime on, several rooms can share one
+    return sorted({room.midi.get("device") for room in rooms if room.play_sound})
+
+def open_midi_port(device):
+    # Open the MIDI output once and keep it open, so playing a chime is just a send()
+    import mido
+    with midi_lock:
+        port = midi_ports.get(device)
+        if port is not None and not port.closed:
+            return port
+        midi_ports.pop(device, None)
+        port = mido.open_output(device)
+        midi_ports[device] = port
+        midi_log.debug("MIDI output '%s' opened", device)
+        return port
+
+def close_midi_port(device=None):
+    # Close one device, or all of them
+    with midi_lock:
+        for name in ([device] if device is not None else list(midi_ports)):
+            port = midi_ports.pop(name, None)
+            if port is not None:
+                port.close()
+
+def check_midi_ports():
+    # Runs on the scheduler: reconnect when a MIDI device comes back after being unplugged
+    import mido
+    available = mido.get_output_names()
+    for device in midi_devices():
+        if device not in available:
+            if device in midi_ports:
+                midi_log.warning("⚠️  MIDI device '%s' disappeared", device)
+                close_midi_port(device)
+            continue
+        if device not in midi_ports:
+            try:
+                open_midi_port(device)
+                midi_log.info("🎹 MIDI device '%s' connected", device)
+            except Exception as e:
+                midi_log.error("❌  ERROR: could not open MIDI device '%s': %s", device, e)
+
+def send_midi(device, message):
+    # Send over the open port, reopening it once if the device went away in the meantime
+    try:
+        open_midi_port(device).send(message)
+    except Exception:
+        close_midi_port(device)
+        open_midi_port(device).send(message)
 
 def bong(n, device, channel, note, duration):
-    outport = mido.open_output(device)
+    # Doesn't block: only the first note_on is sent right away, the rest is done by timers
+    import mido
     on_msg = mido.Message('note_on', channel=channel, note=note)
     off_msg = mido.Message('note_off', channel=channel, note=note)
-    for _ in range(n):
-        outport.send(on_msg)
-        time.sleep(duration)
-        outport.send(off_msg)
-        if n > 1:
-            time.sleep(2)
+    send_midi(device, on_msg)
+    for i in range(n):
+        start = i * (duration + 2)
+        if i > 0:
+            midi_timer(start, device, on_msg)
+        midi_timer(start + duration, device, off_msg)
 
+def midi_timer(delay, device, message):
+    timer = threading.Timer(delay, send_midi, args=(device, message))
+    timer.daemon = True
+    timer.start()
 
 def load_credentials(email, create_if_not_existent=False, verbose=True):
+    from google.auth.transport.requests import Request
+    from google.oauth2.credentials import Credentials
     token_file = f"token_{email}.json"
     credentials_file = f"credentials_{email}.json"
     
-    if verbose: print(f"Trying email address: {email}")
+    if verbose: auth_log.info("Trying email address: %s", email)
 
     # Attempt to load the token file
     if os.path.exists(token_file):
         try:
             creds = Credentials.from_authorized_user_file(token_file, SCOPES)
             if creds.valid:
-                if verbose: print(f"   ✅ Credentials loaded successfully from {token_file}")
+                if verbose: auth_log.info("   ✅ Credentials loaded successfully from %s", token_file)
                 return creds
             if creds.expired and creds.refresh_token:
                 try:
                     creds.refresh(Request())
-                    with open(token_file, 'w') as token:
-                        token.write(creds.to_json())
-                    if verbose: print(f"   🔄 Token refreshed and saved to {token_file}")
+                    save_token(token_file, creds)
+                    if verbose: auth_log.info("   🔄 Token refreshed and saved to %s", token_file)
                     return creds
                 except Exception as e:
-                    if verbose: print(f"   ❌ Error refreshing token: {e}")
+                    if verbose: auth_log.error("   ❌ Error refreshing token: %s", e)
                     return None
         except Exception as e:
-            if verbose: print(f"   ⚠️ Error reading token file {token_file}: {e}")
+            if verbose: auth_log.warning("   ⚠️ Error reading token file %s: %s", token_file, e)
             return None
 
     # Token file does not exist, handle accordingly
     if create_if_not_existent and os.path.exists(credentials_file):
-        if verbose: print(f"   Token file not found, attempting to create from {credentials_file}")
+        if verbose: auth_log.info("   Token file not found, attempting to create from %s", credentials_file)
         try:
+            from google_auth_oauthlib.flow import InstalledAppFlow
             flow = InstalledAppFlow.from_client_secrets_file(credentials_file, SCOPES)
             creds = flow.run_local_server(port=0)
-            with open(token_file, 'w') as token:
-                token.write(creds.to_json())
-            if verbose: print(f"   ✅ New token saved to {token_file}")
+            save_token(token_file, creds)
+            if verbose: auth_log.info("   ✅ New token saved to %s", token_file)
             return creds
         except Exception as e:
-            if verbose: print(f"   ❌ Error generating token from {credentials_file}: {e}")
+            if verbose: auth_log.error("   ❌ Error generating token from %s: %s", credentials_file, e)
             return None
 
-    print(f"   ❌ No valid token or credentials available for {email}.")
+    auth_log.error("   ❌ No valid token or credentials available for %s.", email, extra={"account": email})
     return None
 
+def save_token(token_file, creds):
+    # Write the token atomically (so a crash can't leave half a file), and only if it changed
+    token_json = creds.to_json()
+    try:
+        with open(token_file, 'r') as token:
+            if token.read() == token_json:
+                return False
+    except OSError:
+        pass
+    temp_file = f"{token_file}.tmp"
+    with open(temp_file, 'w') as token:
+        token.write(token_json)
+    os.replace(temp_file, token_file)
+    return True
+
+def get_credentials(email):
+    # Used by the polls: only ever returns what is in memory, so a poll never waits for
+    # the disk or an OAuth round-trip. refresh_credentials() keeps the tokens fresh.
+    return credentials_cache.get(email)
+
+def refresh_credentials():
+    # Runs on the scheduler: renew access tokens a few minutes before they expire
+    from google.auth.transport.requests import Request
+    now = datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None)  # google-auth uses naive UTC
+    for email in email_addresses:
+        creds = credentials_cache.get(email)
+        if creds is None:
+            # e.g. the token file was fixed since startup
+            creds = load_credentials(email, False, False)
+            if creds:
+                credentials_cache[email] = creds
+            continue
+        if not creds.refresh_token or (creds.expiry and creds.expiry - now > datetime.timedelta(seconds=TOKEN_REFRESH_MARGIN_SECONDS)):
+            continue
+        try:
+            creds.refresh(Request())
+            metrics.inc("calendar_chime_token_refreshes_total", account=email, result="ok")
+            if save_token(f"token_{email}.json", creds):
+                auth_log.debug("🔄 Token for %s refreshed and saved", email, extra={"account": email})
+        except Exception as e:
+            metrics.inc("calendar_chime_token_refreshes_total", account=email, result="error")
+            auth_log.error("❌ Error refreshing token for %s: %s", email, e, extra={"account": email})
+
 def load_settings(file_path="settings.json", verbose=True):
     global email_addresses, lighting, midi, hue_bridge, play_sound, change_lights
     if verbose: print(f"🎛️  Loading settings")
@@ -400,6 +2000,7 @@ def load_settings(file_path="settings.json", verbose=True):
             else:
                 print(f"    Hue scene ID: {lighting.get('hue_scene_id')}")
 
+
         midi = settings.get("midi", midi)
         # check for missing MIDI
         if not midi.get("device") or not midi.get("channel") or not midi.get("note") or not midi.get("duration"):
@@ -433,6 +2034,176 @@ def load_settings(file_path="settings.json", verbose=True):
     except Exception as e:
         if verbose: print(f"    ❌  An unexpected error occurred: {e}")
 
+def compile_config(settings, require_accounts=True):
+    # Check the settings and turn them into a Config. Nothing is asked for: incomplete lighting or
+    # MIDI settings just switch the lights or the chime off, anything invalid raises a ValueError
+    problems = []
+    emails = settings.get("email_addresses") or []
+    if not isinstance(emails, list) or not all(isinstance(email, str) and '@' in email for email in emails):
+        problems.append("email_addresses must be a list of email addresses")
+    elif require_accounts and not emails:
+        problems.append("email_addresses is missing")
+
+    config_lighting = dict(settings.get("lighting") or {})
+    config_lighting["use_ha"] = bool(config_lighting.get("ha_url") and config_lighting.get("ha_token") and config_lighting.get("ha_scene_id"))
+    config_lighting["use_hue"] = not config_lighting["use_ha"]
+    config_change_lights = config_lighting["use_ha"] or bool(config_lighting.get("hue_bridge_ip_address") and config_lighting.get("hue_scene_id"))
+
+    config_midi = dict(settings.get("midi") or {"device": None})
+    config_play_sound = all(config_midi.get(key) is not None for key in ("device", "channel", "note", "duration"))
+    if config_play_sound:
+        if not isinstance(config_midi["channel"], int) or not 0 <= config_midi["channel"] <= 15:
+            problems.append("midi channel must be 0 to 15")
+        if not isinstance(config_midi["note"], int) or not 0 <= config_midi["note"] <= 127:
+            problems.append("midi note must be 0 to 127")
+        if not isinstance(config_midi["duration"], (int, float)) or config_midi["duration"] <= 0:
+            problems.append("midi duration must be a positive number of seconds")
+
+    config_lookahead = settings.get("lookahead_hours", 24)
+    if not isinstance(config_lookahead, (int, float)) or config_lookahead <= 0:
+        problems.append("lookahead_hours must be a positive number")
+    config_calendars = settings.get("calendars", "selected")
+    if config_calendars not in ("selected", "primary") and not (isinstance(config_calendars, list) and all(isinstance(calendar_id, str) for calendar_id in config_calendars)):
+        problems.append('calendars must be "selected", "primary" or a list of calendar IDs')
+    config_push = dict(settings.get("push") or {"address": None, "port": 8080})
+    if not isinstance(config_push.get("port", 8080), int):
+        problems.append("push port must be a number")
+    config_metrics_port = settings.get("metrics_port", 9464)
+    if config_metrics_port is not None and not isinstance(config_metrics_port, int):
+        problems.append("metrics_port must be a port number or null")
+    config_logging = dict(settings.get("logging") or {})
+    if config_logging.get("format", "text") not in ("text", "json", "logfmt"):
+        problems.append('logging format must be "text", "json" or "logfmt"')
+    levels = dict(config_logging.get("levels") or {}, **({"": config_logging["level"]} if "level" in config_logging else {}))
+    for subsystem, level in levels.items():
+        if subsystem and subsystem not in LOG_SUBSYSTEMS:
+            problems.append(f"logging levels can be set for {', '.join(LOG_SUBSYSTEMS)}, not {subsystem}")
+        if level not in LOG_LEVELS:
+            problems.append(f"logging level must be one of {', '.join(LOG_LEVELS)}")
+    config_rate_limit = config_logging.get("rate_limit_per_minute", 0)
+    if not isinstance(config_rate_limit, int) or config_rate_limit < 0:
+        problems.append("logging rate_limit_per_minute must be a number, 0 for no limit")
+    config_logging["levels"] = types.MappingProxyType(dict(config_logging.get("levels") or {}))
+    config_expand_recurring = settings.get("expand_recurring", False)
+    if not isinstance(config_expand_recurring, bool):
+        problems.append("expand_recurring must be true or false")
+
+    if problems:
+        raise ValueError(", ".join(problems))
+    return Config(tuple(emails), types.MappingProxyType(config_lighting), types.MappingProxyType(config_midi),
+                  config_play_sound, config_change_lights, config_lookahead,
+                  tuple(config_calendars) if isinstance(config_calendars, list) else config_calendars,
+                  types.MappingProxyType(config_push), config_metrics_port, types.MappingProxyType(config_logging),
+                  config_expand_recurring)
+
+def read_config(file_path="settings.json", require_accounts=True):
+    settings_mtimes[file_path] = os.stat(file_path).st_mtime_ns
+    try:
+        with open(file_path, 'r') as file:
+            settings = json.load(file)
+    except json.JSONDecodeError as e:
+        raise ValueError(f"{file_path} contains invalid JSON: {e}")
+    try:
+        return compile_config(settings, require_accounts)
+    except ValueError as e:
+        raise ValueError(f"{file_path}: {e}")
+
+def apply_config(new_config):
+    # Switch to new settings. The globals below are what the rest of the script reads.
+    global config, email_addresses, lighting, midi, play_sound, change_lights, lookahead_hours, calendars, push, metrics_port, expand_recurring
+    config = new_config
+    email_addresses = new_config.email_addresses
+    lighting = new_config.lighting
+    midi = new_config.midi
+    play_sound = new_config.play_sound
+    change_lights = new_config.change_lights
+    lookahead_hours = new_config.lookahead_hours
+    calendars = new_config.calendars
+    push = new_config.push
+    metrics_port = new_config.metrics_port
+    expand_recurring = new_config.expand_recurring
+    configure_logging(new_config.logging)
+    if email_addresses: settings_log.info("🎛️  Settings: %d accounts, lights %s, chime %s", len(email_addresses),
+                                          'via Home Assistant' if lighting['use_ha'] else 'via Hue' if change_lights else 'off',
+                                          'on ' + str(midi.get('device')) if play_sound else 'off')
+
+def reload_settings(file_path="settings.json"):
+    # Runs on the scheduler: when settings.json changed, check it and switch to it without a restart,
+    # rebuilding only what the change affects. A broken file is reported and the old settings are kept.
+    global hue_bridge, rooms
+    try:
+        if os.stat(file_path).st_mtime_ns == settings_mtimes.get(file_path):
+            return
+        new_config = read_config(file_path)
+    except Exception as e:
+        settings_log.error("❌  ERROR: keeping the previous settings: %s", e)
+        return
+    old_config = config
+    if new_config == old_config:
+        return
+    old_devices = midi_devices()
+    apply_config(new_config)
+    if new_config.calendars != old_config.calendars:
+        calendar_lists.clear()
+        missing_calendars.clear()
+    if new_config.lighting.get("hue_bridge_ip_address") != old_config.lighting.get("hue_bridge_ip_address"):
+        hue_bridge = None
+    if new_config.change_lights and new_config.lighting.get("use_hue"):
+        connectToBridge()
+    if new_config.push != old_config.push or new_config.metrics_port != old_config.metrics_port:
+        settings_log.warning("⚠️  Changes to push and metrics_port take effect after a restart")
+    rooms = [single_room()]
+    check_hue_scenes()
+    update_midi_devices(old_devices)
+    setup_trigger_actions()
+    update_accounts(old_config.email_addresses)
+
+def update_midi_devices(old_devices):
+    # Close the MIDI devices no room uses any more, and open the new ones
+    devices = midi_devices()
+    for device in old_devices:
+        if device not in devices:
+            close_midi_port(device)
+    for device in devices:
+        if device not in old_devices:
+            try:
+                open_midi_port(device)
+            except Exception as e:
+                midi_log.warning("⚠️  Could not open MIDI device '%s', will retry: %s", device, e)
+    if devices and scheduler and not scheduler.get_job('check_midi_ports'):
+        scheduler.add_job(check_midi_ports, 'interval', seconds=30, id='check_midi_ports', coalesce=True)
+
+def update_accounts(old_emails):
+    # Forget the accounts that were removed, and poll the new ones straight away
+    for email in old_emails:
+        if email not in email_addresses:
+            forget_account(email)
+    added = [email for email in email_addresses if email not in old_emails]
+    for email in added:
+        account_creds = load_credentials(email, False, True)
+        if account_creds:
+            credentials_cache[email] = account_creds
+        else:
+            settings_log.warning("    Run 'python3 meeting-start-reminder.py --setup' to connect %s", email)
+    if added:
+        getNextEvent()
+    else:
+        publish_upcoming()
+
+def forget_account(email):
+    settings_log.debug("Forgetting %s", email, extra={"account": email})
+    for channel_id, channel in list(push_channels.items()):
+        if channel["email"] == email:
+            stop_push_channel(channel_id)
+    for (store_email, calendar_id) in list(event_store):
+        if store_email == email:
+            forget_calendar(email, calendar_id)
+    for state in (credentials_cache, calendar_services, calendar_lists, account_events, account_backoff, account_polls):
+        state.pop(email, None)
+    for (missing_email, calendar_id) in list(missing_calendars):
+        if missing_email == email:
+            del missing_calendars[(missing_email, calendar_id)]
+
 def save_settings(file_path, settings, verbose = True):
     if verbose: print(f"Saving new setting: {settings}")
     try:
@@ -443,6 +2214,7 @@ def save_settings(file_path, settings, verbose = True):
         if verbose: print(f"    ❌ Error: Unable to save settings to {file_path}: {e}")
 
 def guide_user_to_connect_hue_bridge(verbose = True):
+    import discoverhue
     if verbose: print('    Scanning for available bridges:')
     bridges = discoverhue.find_bridges()
 
@@ -467,6 +2239,7 @@ def guide_user_to_enter_email_addresses(filename="settings_email.txt", verbose =
     return email_addresses
 
 def guide_user_to_enter_midi_data(midi, verbose = True):
+    import mido
     if midi.get("device") is None:
         # List available input ports
         input_ports = mido.get_input_names()
@@ -546,19 +2319,23 @@ def guide_user_to_enter_midi_data(midi, verbose = True):
 def guide_user_to_lighting_scene_id():
     global lighting, hue_bridge
     connectToBridge()
-    bridge = hue_bridge
-    # Get groups (rooms) from the Hue bridge
-    # pdb.set_trace()
-    # Get all groups (rooms and zones)
-    groups = bridge.groups
+    if hue_bridge is None:
+        return None
+    # One request gets all the groups (rooms and zones) and scenes of the bridge
+    try:
+        state = hue_state(lighting.get("hue_bridge_ip_address"), hue_bridge.username).get()
+    except Exception as e:
+        print(f"Could not get the groups and scenes from the Hue bridge: {e}")
+        return None
+    groups = list(state.get("groups", {}).items())
     if not groups:
         print("No groups available on the Hue bridge.")
         return None
 
     # Enumerate all groups (rooms)
     print("Available groups:")
-    for i, group in enumerate(groups, start=1):
-        print(f"{i}. {group.name}")
+    for i, (group_id, group) in enumerate(groups, start=1):
+        print(f"{i}. {group['name']}")
 
     try:
         group_choice = int(input("Select a group by number: ")) - 1
@@ -569,14 +2346,11 @@ def guide_user_to_lighting_scene_id():
         print("Invalid input. Please enter a number.")
         return None
 
-    selected_group = groups[group_choice]
-    selected_group_id = selected_group.group_id
-    selected_group_name = selected_group.name
+    selected_group_id, selected_group = groups[group_choice]
+    selected_group_name = selected_group['name']
 
-    # pdb.set_trace()
     # Get scenes linked to the selected group
-    scenes = bridge.scenes
-    group_scenes = {scene.scene_id: scene for scene in scenes if scene.group == str(selected_group_id)}
+    group_scenes = {scene_id: scene for scene_id, scene in state.get("scenes", {}).items() if scene.get("group") == selected_group_id}
 
     if not group_scenes:
         print(f"No scenes available for group: {selected_group_name}")
@@ -585,7 +2359,7 @@ def guide_user_to_lighting_scene_id():
     # Enumerate scenes and ask the user to choose one
     print(f"Available scenes for group '{selected_group_name}':")
     for i, (scene_id, scene) in enumerate(group_scenes.items(), start=1):
-        print(f"{i}. {scene.name}")
+        print(f"{i}. {scene['name']}")
 
     try:
         scene_choice = int(input("Select a scene by number: ")) - 1
@@ -597,23 +2371,10 @@ def guide_user_to_lighting_scene_id():
         return None
 
     selected_scene_id = list(group_scenes.keys())[scene_choice]
-    selected_scene_name = group_scenes[selected_scene_id].name
+    selected_scene_name = group_scenes[selected_scene_id]['name']
 
     print(f"You selected scene: '{selected_scene_name}' with ID: {selected_scene_id}")
     return selected_scene_id
 
-def checkSensorBatteryLevels(bridge):
-    sensor_names = bridge.get_sensor_objects('name')
-    sensor_ids = bridge.get_sensor_objects('id')
-    sensors = bridge.get_sensor_objects()
-    counter = 0
-    for sensor in sensors:
-        config = sensor._get('config')
-        if "battery" in config and config['battery'] < 15:
-            print(f'🔋🚨: {sensor._get("name")} battery is low ({config["battery"]}% )')
-            counter += 1
-    if counter == 0:
-        print('🔋: all good - no sensors have < 15% battery')
-
 if __name__ == '__main__':
     main()
@@ -0,0 +1,95 @@
+# Checks the expansion of recurring meetings with expand_recurring (RRULE, EXDATE, UNTIL, moved and
+# cancelled instances, daylight saving time) and how their instances are kept in the local store:
+#
+#   python3 -m pytest test_recurring.py
+#   python3 -m unittest test_recurring
+
+import datetime
+import unittest
+
+import benchmark
+from benchmark import reminder
+
+EMAIL = 'me@example.com'
+ATTENDEES = [{'email': EMAIL, 'self': True, 'responseStatus': 'accepted'}]
+
+
+def utc(text):
+    return datetime.datetime.fromisoformat(text).replace(tzinfo=datetime.timezone.utc)
+
+
+class RecurringExpansionTest(unittest.TestCase):
+
+    def test_rrule_exdate_until_and_exceptions_across_dst(self):
+        # Mondays and Wednesdays at 9:30 in Berlin, which moves to summer time on 30 March
+        events = [
+            {'id': 'standup', 'summary': 'Standup', 'eventType': 'default', 'attendees': ATTENDEES,
+             'start': {'dateTime': '2025-03-03T09:30:00+01:00', 'timeZone': 'Europe/Berlin'},
+             'recurrence': ['RRULE:FREQ=WEEKLY;BYDAY=MO,WE;UNTIL=20250410T215959Z',  # 23:59:59 on 10 April in Berlin
+                            'EXDATE;TZID=Europe/Berlin:20250326T093000']},
+            {'id': 'standup_20250331T073000Z', 'recurringEventId': 'standup', 'summary': 'Standup (moved)',
+             'eventType': 'default', 'attendees': ATTENDEES,
+             'originalStartTime': {'dateTime': '2025-03-31T09:30:00+02:00', 'timeZone': 'Europe/Berlin'},
+             'start': {'dateTime': '2025-03-31T11:00:00+02:00'}},
+            {'id': 'standup_20250402T073000Z', 'recurringEventId': 'standup', 'status': 'cancelled',
+             'originalStartTime': {'dateTime': '2025-04-02T09:30:00+02:00', 'timeZone': 'Europe/Berlin'}},
+        ]
+        instances = reminder.expand_recurring_events(events, utc('2025-03-24T00:00:00'), utc('2025-04-20T00:00:00'))
+        starts = sorted((reminder.parse_event_time(event['start']['dateTime']), event['id']) for event in instances)
+        self.assertEqual(starts, [
+            (utc('2025-03-24T08:30:00'), 'standup_20250324T083000Z'),
+            (utc('2025-03-31T09:00:00'), 'standup_20250331T073000Z'),  # moved, and summer time
+            (utc('2025-04-07T07:30:00'), 'standup_20250407T073000Z'),
+            (utc('2025-04-09T07:30:00'), 'standup_20250409T073000Z'),
+        ])
+
+    def test_date_exdate_skips_that_days_instance(self):
+        events = [{'id': 'daily', 'summary': 'Daily', 'eventType': 'default', 'attendees': ATTENDEES,
+                   'start': {'dateTime': '2025-01-06T10:00:00Z', 'timeZone': 'UTC'},
+                   'recurrence': ['RRULE:FREQ=DAILY;COUNT=5', 'EXDATE;VALUE=DATE:20250108']}]
+        instances = reminder.expand_recurring_events(events, utc('2025-01-01T00:00:00'), utc('2025-01-31T00:00:00'))
+        self.assertEqual(sorted(event['start']['dateTime'] for event in instances),
+                         ['2025-01-06T10:00:00Z', '2025-01-07T10:00:00Z', '2025-01-09T10:00:00Z', '2025-01-10T10:00:00Z'])
+
+
+class MovedInstanceStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        benchmark.reset()
+        self.calendar = (EMAIL, 'primary')
+        reminder.event_store[self.calendar] = {"events": {}, "sync_token": None, "window_end": None, "expanded": True}
+
+    def sync(self, now, items, sync_token=None):
+        time_max = (now + datetime.timedelta(hours=reminder.SYNC_WINDOW_FACTOR * reminder.lookahead_hours)).isoformat()
+        sync = {"sync_token": sync_token, "page_token": None, "items": items, "expanded": True,
+                "next_sync_token": str(int(sync_token or 0) + 1)}
+        reminder.apply_sync(EMAIL, 'primary', sync, time_max, now)
+        return [(start, reminder.event_title(event)) for start, event in
+                reminder.accepted_meetings(EMAIL, reminder.stored_events(EMAIL), now) if start > now]
+
+    def test_instance_moved_earlier_does_not_bring_back_its_original_slot(self):
+        # Weekly on Thursdays at 10:00 in Berlin, this week's meeting moved to Wednesday 15:00
+        series = {'id': 'weekly', 'summary': 'Weekly', 'eventType': 'default', 'attendees': ATTENDEES,
+                  'start': {'dateTime': '2025-02-06T10:00:00+01:00', 'timeZone': 'Europe/Berlin'},
+                  'recurrence': ['RRULE:FREQ=WEEKLY;BYDAY=TH']}
+        moved = {'id': 'weekly_20250306T090000Z', 'recurringEventId': 'weekly', 'summary': 'Weekly (moved)',
+                 'eventType': 'default', 'attendees': ATTENDEES,
+                 'originalStartTime': {'dateTime': '2025-03-06T10:00:00+01:00', 'timeZone': 'Europe/Berlin'},
+                 'start': {'dateTime': '2025-03-05T15:00:00+01:00'}}
+
+        meetings = self.sync(utc('2025-03-04T12:00:00'), [series, moved])
+        self.assertEqual(meetings, [(utc('2025-03-05T14:00:00'), 'Weekly (moved)')])
+
+        # After the moved meeting, nothing else this week
+        meetings = self.sync(utc('2025-03-05T15:00:00'), [], "1")
+        self.assertIn(moved['id'], reminder.event_store[self.calendar]["events"])
+        self.assertEqual(meetings, [])
+
+        # Once the original slot has passed as well, the instance is no longer needed
+        meetings = self.sync(utc('2025-03-11T12:00:00'), [], "2")
+        self.assertNotIn(moved['id'], reminder.event_store[self.calendar]["events"])
+        self.assertEqual(meetings, [(utc('2025-03-13T09:00:00'), 'Weekly')])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,84 @@
+# Checks that the chime and the lights go off on time while the Google Calendar API hangs,
+# using the fakes from benchmark.py:
+#
+#   python3 -m pytest test_triggers.py
+#   python3 -m unittest test_triggers
+
+import concurrent.futures
+import datetime
+import threading
+import time
+import unittest
+
+import benchmark
+from benchmark import reminder
+
+SPEED = 10  # the virtual clock runs this much faster than real time
+MAX_LATENESS_SECONDS = 0.5  # in real time, either side of WARNING_TIME_SECONDS before the meeting
+
+
+class SlowApiTriggerTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        reminder.clock = reminder.VirtualClock(time.time(), SPEED)
+        threading.Thread(target=reminder.continuous_event_check, daemon=True).start()
+
+    def setUp(self):
+        benchmark.reset()
+        self.midi_port = benchmark.FakeMidiPort('Test MIDI')
+        reminder.midi_ports[self.midi_port.name] = self.midi_port
+        self.lights = benchmark.FakeLights()
+        self.addCleanup(self.lights.server.shutdown)
+        reminder.http_session = reminder.trigger_session = None
+        reminder.action_executor = concurrent.futures.ThreadPoolExecutor(max_workers=reminder.ACTION_WORKERS, thread_name_prefix="action")
+
+    def test_triggers_fire_on_time_while_the_api_hangs(self):
+        gap = 10
+        first_start = reminder.clock.now().replace(microsecond=0) + datetime.timedelta(
+            seconds=reminder.WARNING_TIME_SECONDS + reminder.PREWARM_SECONDS + 10)
+        apis = benchmark.make_accounts(1, 2, 0.0, 0.0, first_start, gap)
+        lighting = {"use_hue": False, "use_ha": True, "ha_url": f"http://{self.lights.address}", "ha_token": "test", "ha_scene_id": "scene.test"}
+        midi = {"device": self.midi_port.name, "channel": 0, "note": 60, "duration": 0.1}
+        reminder.rooms = [reminder.Room("", reminder.email_addresses, lighting, midi, True, True)]
+        reminder.setup_trigger_actions()
+        reminder.getNextEvent()
+        self.assertEqual(len(reminder.upcoming), 2)
+
+        # From now on every API request hangs until the end of the test, for much longer than the warning window
+        api = apis[reminder.email_addresses[0]]
+        unblocked = threading.Event()
+        blocked = []
+        request = api.request
+        def blocked_request(*args, **kwargs):
+            blocked.append(reminder.clock.time())
+            unblocked.wait()
+            return request(*args, **kwargs)
+        api.request = blocked_request
+        self.addCleanup(unblocked.set)
+
+        done = threading.Event()
+        def poll():
+            while not done.is_set():
+                reminder.getNextEvent()
+                time.sleep(0.05)
+        poller = threading.Thread(target=poll, daemon=True)
+        poller.start()
+        self.addCleanup(done.set)
+
+        intended = [(first_start + datetime.timedelta(seconds=i * gap)).timestamp() - reminder.WARNING_TIME_SECONDS for i in range(2)]
+        deadline = time.monotonic() + 30
+        while (len(self.midi_port.notes) < 2 or len(self.lights.scenes) < 2) and time.monotonic() < deadline:
+            time.sleep(0.05)
+        self.assertTrue(blocked, "the API was not polled while the triggers went off")
+        self.assertLess(blocked[0], intended[0] - reminder.WARNING_TIME_SECONDS)
+
+        for name, times in (("chime", self.midi_port.notes), ("lights", self.lights.scenes)):
+            self.assertEqual(len(times), 2, f"{name} went off {len(times)} times")
+            for fired, wanted in zip(sorted(times), intended):
+                self.assertLess(abs(fired - wanted) / SPEED, MAX_LATENESS_SECONDS,
+                                f"{name} went off {(fired - wanted) / SPEED:+.3f}s from {reminder.WARNING_TIME_SECONDS}s before the meeting")
+
+
+if __name__ == '__main__':
+    unittest.main()